@@ -9,8 +9,10 @@
 
 #basefolder = "."
 
-import math, urllib, os, errno
+import math, urllib, os, errno, time, thread
 
+OSM_TILE_SIZE = 256 # width and height of a tile in pixels
+OSM_EARTH_CIRCUMFERENCE = 40075016.686 # in meters, at the equator
 
 def OSM_deg2num(lat_deg, lon_deg, zoom):
 	lat_rad = lat_deg * math.pi / 180.0
@@ -36,23 +38,267 @@ def OSM_num2deg(xtile, ytile, zoom):
 
 
 class OSM_Loader():
-	def __init__(self, url = "http://tile.openstreetmap.org/%d/%d/%d.png", folder='.'):
+	def __init__(self, url = "http://tile.openstreetmap.org/%d/%d/%d.png", folder='.', retry_after = 300.):
 		self.baseurl = url
 		self.folder  = folder
+		self.retry_after = retry_after	# seconds before a failed tile is requested again
+		self.failed  = {}	# (zoom, x, y) -> time of the failed download
+		self.loading = {}	# (zoom, x, y) -> lock which is held during the download
+		self.lock = thread.allocate_lock() # protects failed and loading
+		self.foreground = 0	# number of running downloads which are not in the background
+		self.stats = {}		# counters of the requests, see clear_stats
+		self.clear_stats()
+
+	def clear_stats(self):
+		self.stats = {
+			'hits' : 0,			# tile found on the disk
+			'offline' : 0,		# tile missing, but not online
+			'negative' : 0,		# tile failed not long ago
+			'coalesced' : 0,	# waited for the download of somebody else
+			'downloads' : 0,	# successful downloads
+			'failed' : 0,		# failed downloads
+			'bytes' : 0			# downloaded bytes
+		}
 
 	def get_map(self, lat, lon, zoom = 16, online=True):
 		res = OSM_deg2num(lat, lon,zoom)
-		url = self.baseurl % (zoom, res[0], res[1])
-		folder = os.path.join(self.folder, str(zoom), str(res[0]))
-		try:	os.makedirs(folder)
+		return self.get_tile(zoom, res[0], res[1], online)
+
+	def tile_file(self, zoom, x, y):
+		return os.path.join(self.folder, str(zoom), str(x), str(y)) + '.png'
+
+	def get_tile(self, zoom, x, y, online=True, background=False):
+		"""Returns (filename, x, y) of the tile, the filename is None if the
+		tile is not available. Tiles which are not on the disk are only
+		downloaded when online is True. Concurrent requests for the same
+		tile wait for one download, failed tiles are not requested again
+		for retry_after seconds. Background downloads are not counted in
+		foreground, so prefetching can give way to them."""
+		file = self.tile_file(zoom, x, y)
+		if os.path.exists(file):
+			self.stats['hits'] += 1
+			return file, x, y
+		if not online:
+			self.stats['offline'] += 1
+			return None, x, y
+
+		key = (zoom, x, y)
+		self.lock.acquire()
+		if self.failed.has_key(key):
+			if time.time() - self.failed[key] < self.retry_after:
+				self.stats['negative'] += 1
+				self.lock.release()
+				return None, x, y
+			del self.failed[key]
+
+		if self.loading.has_key(key): # somebody else is downloading the tile, wait for it
+			loading = self.loading[key]
+			self.stats['coalesced'] += 1
+			self.lock.release()
+			loading.acquire()
+			loading.release()
+			if os.path.exists(file):	return file, x, y
+			return None, x, y
+
+		loading = thread.allocate_lock()
+		loading.acquire()
+		self.loading[key] = loading
+		if not background: self.foreground += 1
+		self.lock.release()
+
+		done = False
+		try:
+			done = self.download(self.baseurl % (zoom, x, y), file)
+		finally:
+			self.lock.acquire()
+			if done:
+				self.stats['downloads'] += 1
+				self.stats['bytes'] += os.path.getsize(file)
+			else:
+				self.stats['failed'] += 1
+				self.forget_failures()
+				self.failed[key] = time.time()
+			if not background: self.foreground -= 1
+			del self.loading[key]
+			self.lock.release()
+			loading.release()
+
+		if done:	return file, x, y
+		return None, x, y
+
+	def forget_failures(self):
+		"""Drops the failed tiles which may be requested again, so failed
+		doesn't grow on a long ride without coverage. Call with lock held."""
+		now = time.time()
+		for key, failed in self.failed.items():
+			if now - failed >= self.retry_after: del self.failed[key]
+
+	def download(self, url, file):
+		"Downloads a tile, returns True if it worked"
+		try:	os.makedirs(os.path.dirname(file))
 		except OSError, e :					# if path already exists, an exceptions is raised
 			if e.errno != errno.EEXIST : raise # if it was another exception, then raise again
 
-		file = os.path.join(folder, str(res[1])) + '.png'
-		if not os.path.exists(file):
-			urllib.urlretrieve(url, file)
+		# download into a temporary file, so nobody reads a half written tile
+		part = file + '.part'
+		try:
+			headers = urllib.urlretrieve(url, part)[1]
+		except IOError:
+			headers = None
+		if headers == None or not headers.gettype().startswith('image'): # error pages are no tiles
+			try:	os.remove(part)
+			except OSError: pass
+			return False
+		os.rename(part, file)
+		return True
+
+
+class OSM_Prefetcher:
+	"""Downloads the tiles ahead of the rider in a background thread.
+	The tiles needed within the next minutes are predicted from the
+	position, the heading and the remaining waypoints. They are only
+	downloaded while the loader has no foreground downloads, and at no
+	more than max_rate bytes per second. With nothing to do it looks
+	again after idle seconds.
+	Tiles the map screen needs right now are handed over with request(),
+	they are downloaded first and without the rate limit."""
+	def __init__(self, loader, max_rate = 4096, minutes = 5., radius = 1, min_speed = 2., idle = 0.5):
+		self.loader = loader
+		self.max_rate = max_rate	# bytes per second, 0 means unlimited
+		self.minutes = minutes		# how far to look ahead
+		self.radius = radius		# tiles around the predicted way
+		self.min_speed = min_speed	# meters per second, assumed when standing
+		self.idle = idle			# seconds to sleep when there's nothing to download
+		self.queue = []				# (zoom, x, y) of the tiles still to download
+		self.wanted = []			# (zoom, x, y) of tiles on the screen, see request
+		self.tiles = {}				# all predicted tiles of the last prediction
+		self.zoom = None
+		self.route_id = None
+		self.heading = None
+		self.origin = None			# position of the last prediction in tile coordinates
+		self.horizon = 0.			# look ahead distance in tiles
+		self.lock = thread.allocate_lock() # protects queue and wanted
+		self.bytes = 0				# downloaded bytes
+		self.going = False
+		self.running = thread.allocate_lock() # held while the thread runs
+
+	def start(self):
+		if not self.going:
+			self.going = True
+			self.running.acquire()
+			thread.start_new_thread(self.run, ())
+
+	def stop(self, wait = False):
+		"""Stops the thread, and waits until it has finished the download
+		it was at if wait is True"""
+		self.going = False
+		if wait:
+			self.running.acquire()
+			self.running.release()
+
+	def run(self):
+		try:
+			self.fetch()
+		finally:
+			self.running.release()
+
+	def request(self, tiles):
+		"""Downloads the tiles (zoom, x, y) before any predicted ones,
+		they replace the tiles of the last request"""
+		self.lock.acquire()
+		self.wanted = list(tiles)
+		self.lock.release()
+
+	def fetch(self):
+		while self.going:
+			tile = None
+			wanted = False
+			self.lock.acquire()
+			if len(self.wanted) > 0:
+				tile = self.wanted.pop(0)
+				wanted = True
+			elif len(self.queue) > 0 and self.loader.foreground == 0:
+				tile = self.queue.pop(0)
+			self.lock.release()
+
+			if tile == None:
+				time.sleep(self.idle)
+				continue
+			if os.path.exists(self.loader.tile_file(tile[0], tile[1], tile[2])):
+				continue
+
+			file = self.loader.get_tile(tile[0], tile[1], tile[2], background = True)[0]
+			if file:
+				size = os.path.getsize(file)
+				self.bytes += size
+				if self.max_rate > 0 and not wanted: time.sleep(float(size) / self.max_rate)
+
+	def deviated(self, zoom, pos, heading, route_id):
+		"Checks if the last prediction is stale"
+		if self.origin == None or zoom != self.zoom or route_id != self.route_id:
+			return True
+		if not self.tiles.has_key((zoom, int(pos[0]), int(pos[1]))):
+			return True # left the predicted way
+		if heading != None and self.heading != None and route_id == None:
+			d = abs(heading - self.heading) % 360.
+			if d > 180.: d = 360. - d
+			if d > 45.: return True
+		dx = pos[0] - self.origin[0]
+		dy = pos[1] - self.origin[1]
+		return math.sqrt(dx*dx + dy*dy) > self.horizon / 2.
+
+	def update(self, lat, lon, heading, speed, zoom, route = None, route_id = None):
+		"""Predicts the tiles needed in the next minutes, if the last
+		prediction is stale. heading is in degrees or None, speed in
+		meters per second. route iterates over (lat, lon) of the remaining
+		waypoints, route_id changes whenever the route does."""
+		pos = OSM_deg2xy(lat, lon, zoom)
+		if not self.deviated(zoom, pos, heading, route_id): return
+
+		tile_m = OSM_EARTH_CIRCUMFERENCE * math.cos(lat * math.pi / 180.) / 2 ** zoom
+		horizon = max(speed, self.min_speed) * self.minutes * 60. / tile_m
 
-		return file, res[0], res[1] # filename, x, y
+		# walk along the way until the horizon is reached
+		tiles = {}
+		order = []
+		def add(x, y):
+			for i in range(int(x) - self.radius, int(x) + self.radius + 1):
+				for j in range(int(y) - self.radius, int(y) + self.radius + 1):
+					if not tiles.has_key((zoom, i, j)):
+						tiles[(zoom, i, j)] = True
+						order.append((zoom, i, j))
 
+		def walk(last, next, left):
+			"adds the tiles from last to next, returns the distance walked"
+			dx = next[0] - last[0]
+			dy = next[1] - last[1]
+			dist = min(math.sqrt(dx*dx + dy*dy), left)
+			steps = int(dist * 2.) + 1 # two samples per tile
+			if dist > 0.:
+				for k in range(1, steps + 1):
+					f = dist / math.sqrt(dx*dx + dy*dy) * k / steps
+					add(last[0] + f * dx, last[1] + f * dy)
+			return dist
 
+		add(pos[0], pos[1])
+		left = horizon
+		last = pos
+		if route != None:
+			for w in route:
+				next = OSM_deg2xy(w[0], w[1], zoom)
+				left -= walk(last, next, left)
+				last = next
+				if left <= 0.: break
+		elif heading != None:
+			h = heading * math.pi / 180.
+			walk(pos, [pos[0] + horizon * math.sin(h), pos[1] - horizon * math.cos(h)], horizon)
 
+		self.zoom = zoom
+		self.route_id = route_id
+		self.heading = heading
+		self.origin = pos
+		self.horizon = horizon
+		self.tiles = tiles
+		self.lock.acquire()
+		self.queue = order # replaces the stale prediction
+		self.lock.release()
@@ -0,0 +1,233 @@
+# Benchmark for the NMEA parsing of nmea_parser.py
+#
+# Generates a corpus of captures with nmea_generator, seeded so every
+# run sees the same data:
+#  clean      - 1 Hz, every sentence intact
+#  noisy      - position noise, lost and garbled sentences
+#  fragmented - clean data, read in small chunks of random size
+#  checksums  - one sentence in ten with a wrong checksum
+#  nmea23     - RMC and VTG with the mode field of NMEA 2.3
+#  gsv_last   - the GSVs after the RMC and VTG, the epoch ends with a GSV
+#  multi      - GN, GL and GA talkers, as multi-constellation receivers send
+#  10hz, 20hz - high rate receivers
+# Recorded captures can be added with --captures, one per file.
+#
+# For every capture the framing (NmeaParser.feed), the checksums and the
+# handlers of GGA, RMC, GSV, GSA and VTG are timed on their own, and the
+# sentences/sec and what is retained per sentence are reported. The
+# parser takes the sentences of any talker, so the GN, GL and GA of the
+# multi capture are parsed and not just dropped.
+# The updates of the framing are also put together into epochs by an
+# EpochAssembler, which should find one epoch per RMC.
+# Retained is what is still alive after a run, the results included:
+# the memory blocks tracemalloc sees if it's there, else the objects
+# the garbage collector tracks (dicts, lists, ...), with collection off.
+# Neither counts the temporary strings and numbers which are freed again
+# within the run, python 2 has no way to count those.
+#
+# Runs on a desktop python 2, not on the phone:
+#  python bench_nmea.py --epochs 2000 --captures ride1.nmea,ride2.nmea
+
+import sys, os, time, gc, random
+from optparse import OptionParser
+
+from nmea_parser import *
+from nmea_generator import NmeaGenerator, nmea_sentence
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+HANDLERS = [
+	('GGA', do_gga_location),
+	('RMC', do_rmc_location),
+	('GSV', do_gsv_satellite_view),
+	('GSA', do_gsa_satellites_used),
+	('VTG', do_vtg_motion),
+]
+
+def generate(epochs, seed, rate = 1., **options):
+	generator = NmeaGenerator(route = [(52.52, 13.40), (52.53, 13.42), (52.51, 13.43)],
+		rate = rate, satellites = 12, seed = seed, **options)
+	generator.time = 1262304000. # 2010-01-01, the same for every run
+	return ''.join([generator.epoch() for i in range(epochs)])
+
+def wrong_checksums(data, seed, every = 10):
+	"Breaks the checksum of one sentence in every"
+	rand = random.Random(seed)
+	lines = data.split('\n')
+	for i in range(len(lines)):
+		if lines[i][-4:-3] == '*' and rand.randint(1, every) == 1:
+			lines[i] = lines[i][:-3] + "%02X\r" % ((int(lines[i][-3:-1], 16) + 1) & 0xFF)
+	return '\n'.join(lines)
+
+def multi_constellation(data):
+	"Sends the fix as GN, and the satellites as GP, GL and GA"
+	out = []
+	for line in data.split('\n'):
+		if not line.startswith('$GP'):
+			out.append(line + '\n')
+			continue
+		body = line[3:line.rfind('*')]
+		if body[:3] in ('GSV', 'GSA'):
+			for talker in ('GP', 'GL', 'GA'):
+				out.append(nmea_sentence(talker + body))
+		else:
+			out.append(nmea_sentence('GN' + body))
+	return ''.join(out)[:-1]
+
+def corpus(options):
+	"The captures as (name, data, chunk sizes)"
+	seed = options.seed
+	n = options.epochs
+	captures = [
+		('clean', generate(n, seed), None),
+		('noisy', generate(n, seed, noise = 5., dropout = 0.02, corrupt = 0.02), None),
+		('fragmented', generate(n, seed), (1, 64)),
+		('checksums', wrong_checksums(generate(n, seed), seed), None),
+		('nmea23', generate(n, seed, mode = True), None),
+		('gsv_last', generate(n, seed, gsv_last = True), None),
+		('multi', multi_constellation(generate(n, seed)), None),
+		('10hz', generate(n * 10, seed, rate = 10.), None),
+		('20hz', generate(n * 20, seed, rate = 20.), None),
+	]
+	for filename in filter(None, options.captures.split(',')):
+		f = open(filename, 'rb')
+		captures.append((os.path.basename(filename), f.read(), None))
+		f.close()
+	return captures
+
+def chunks(data, sizes, seed):
+	"data split into chunks of 1024 bytes, or of random sizes between sizes"
+	if sizes == None:
+		return [data[i:i+1024] for i in range(0, len(data), 1024)]
+	rand = random.Random(seed)
+	result = []
+	i = 0
+	while i < len(data):
+		size = rand.randint(sizes[0], sizes[1])
+		result.append(data[i:i+size])
+		i += size
+	return result
+
+def measure(run, repeat):
+	"""Runs run() repeat times, returns the best time and the memory
+	blocks or objects one run leaves alive, see above"""
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		run()
+		elapsed = time.time() - start
+		if best == None or elapsed < best: best = elapsed
+
+	gc.collect()
+	if tracemalloc != None:
+		tracemalloc.start()
+		before = tracemalloc.take_snapshot()
+		result = run()
+		after = tracemalloc.take_snapshot()
+		tracemalloc.stop()
+		retained = sum([stat.count_diff for stat in after.compare_to(before, 'lineno') if stat.count_diff > 0])
+		del result
+	else:
+		gc.disable()
+		before = len(gc.get_objects())
+		result = run()
+		retained = len(gc.get_objects()) - before
+		del result
+		gc.enable()
+	return best, retained
+
+# What measure counts
+if tracemalloc != None:	RETAINED = 'retained blocks'
+else:					RETAINED = 'retained objects'
+
+def report(name, stage, sentences, elapsed, retained):
+	rate = 0.
+	if elapsed > 0.: rate = sentences / elapsed
+	per = 0.
+	if sentences > 0: per = float(retained) / sentences
+	print "%-12s %-10s %8d sentences %10.0f sentences/s %6.2f %s/sentence" % (name, stage, sentences, rate, per, RETAINED)
+
+def bench(name, data, sizes, options):
+	pieces = chunks(data, sizes, options.seed)
+	lines = data.split('\n')
+
+	def framing():
+		parser = NmeaParser()
+		parser.accept_talkers(None)
+		updates = []
+		for piece in pieces:
+			updates.extend(parser.feed(piece))
+		return updates
+	elapsed, allocations = measure(framing, options.repeat)
+	report(name, 'framing', len([line for line in lines if '$' in line]), elapsed, allocations)
+
+	# The epochs of the updates, one per RMC
+	assembler = EpochAssembler()
+	epochs = []
+	for update in framing():
+		epochs.extend(assembler.add(update, 0.))
+	if assembler.pending: epochs.append(assembler.pending)
+	fixes = len([line for line in lines if line[3:6] == 'RMC'])
+	print "%-12s %-10s %8d epochs for %d fixes" % (name, 'epochs', len(epochs), fixes)
+
+	# The checksums alone
+	sums = []
+	for line in lines:
+		line = line.rstrip()
+		dollar = line.rfind('$')
+		if dollar != -1 and line[-3:-2] == '*':
+			sums.append((line[dollar + 1:-3], line[-2:]))
+	def checksums():
+		return [checksum_ok(data, digits) for data, digits in sums]
+	elapsed, allocations = measure(checksums, options.repeat)
+	report(name, 'checksum', len(sums), elapsed, allocations)
+
+	# The handlers alone, on the fields of their sentences
+	for sentence_id, handler in HANDLERS:
+		fields = []
+		for line in lines:
+			dollar = line.rfind('$')
+			if dollar == -1 or line[dollar + 3:dollar + 6] != sentence_id: continue
+			line = line[dollar:].rstrip()
+			if line[-3:-2] == '*': line = line[:-3]
+			fields.append((line[1:3], line[7:].split(',')))
+		if not fields: continue
+		def handle():
+			state = {'satellites' : SatelliteTable()}
+			updates = []
+			for talker, d in fields:
+				state['talker'] = talker
+				try:
+					updates.append(handler(d, state))
+				except NMEA_ERRORS:
+					pass
+			return updates
+		elapsed, allocations = measure(handle, options.repeat)
+		report(name, sentence_id, len(fields), elapsed, allocations)
+
+def main():
+	parser = OptionParser()
+	parser.add_option('--epochs', type='int', default=2000, help='epochs per generated capture, times the rate')
+	parser.add_option('--seed', type='int', default=1)
+	parser.add_option('--repeat', type='int', default=3, help='runs per measurement, the best counts')
+	parser.add_option('--captures', default='', help='comma separated NMEA files to add to the corpus')
+	parser.add_option('--only', default='', help='comma separated names of the captures to run')
+	parser.add_option('--save', default='', help='folder to write the generated corpus to')
+	options, args = parser.parse_args()
+
+	only = filter(None, options.only.split(','))
+	if tracemalloc == None:
+		print "No tracemalloc, retained are the objects tracked by the garbage collector"
+	for name, data, sizes in corpus(options):
+		if only and name not in only: continue
+		if options.save:
+			f = open(os.path.join(options.save, name + '.nmea'), 'wb')
+			f.write(data)
+			f.close()
+		bench(name, data, sizes, options)
+
+if __name__ == '__main__':
+	main()
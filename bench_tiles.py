@@ -0,0 +1,235 @@
+# Benchmark for the tile loading of OSM.py
+#
+# Starts a local HTTP server which stands in for the tile server and
+# drives OSM_Loader through several workloads:
+#  cold    - a grid of tiles into an empty cache
+#  warm    - the same grid again, everything is on the disk
+#  route   - riding along a route with OSM_Prefetcher, the map screen
+#            only uses tiles which are on the disk already
+#  pan     - random pans of the map screen
+# For every workload tiles/sec, p50/p99 latency, downloaded bytes and the
+# cache hit rate are reported.
+#
+# Runs on a desktop python 2, not on the phone:
+#  python bench_tiles.py --latency 150 --bandwidth 20000 --workers 2
+
+import sys, os, time, math, random, shutil, tempfile, threading, Queue
+import BaseHTTPServer, SocketServer
+from optparse import OptionParser
+
+from OSM import *
+
+PNG_HEADER = '\x89PNG\r\n\x1a\n'
+
+class TileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	latency = 0.		# seconds before the answer is sent
+	bandwidth = 0		# bytes per second and connection, 0 = unlimited
+	error_rate = 0.		# fraction of requests answered with an error
+	tile_size = 15000	# bytes per tile
+	requests = 0
+
+class TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		server = self.server
+		server.requests += 1
+		if server.latency > 0.: time.sleep(server.latency)
+
+		if random.random() < server.error_rate:
+			self.send_response(500)
+			self.send_header('Content-Type', 'text/html')
+			self.end_headers()
+			self.wfile.write('<html>server error</html>')
+			return
+
+		body = PNG_HEADER + 'x' * max(0, server.tile_size - len(PNG_HEADER))
+		self.send_response(200)
+		self.send_header('Content-Type', 'image/png')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		if server.bandwidth <= 0:
+			self.wfile.write(body)
+			return
+		chunk = max(1, server.bandwidth / 10)
+		for i in range(0, len(body), chunk):
+			self.wfile.write(body[i:i+chunk])
+			time.sleep(float(len(body[i:i+chunk])) / server.bandwidth)
+
+	def log_message(self, format, *args):
+		pass
+
+def start_server(options):
+	server = TileServer(('127.0.0.1', 0), TileHandler)
+	server.latency = options.latency / 1000.
+	server.bandwidth = options.bandwidth
+	server.error_rate = options.error_rate
+	server.tile_size = options.tile_size
+	t = threading.Thread(target=server.serve_forever)
+	t.setDaemon(True)
+	t.start()
+	return server
+
+def percentile(values, p):
+	if len(values) == 0: return 0.
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100.))]
+
+class Result:
+	def __init__(self, name):
+		self.name = name
+		self.latencies = []	# seconds per request
+		self.hits = 0
+		self.elapsed = 0.
+		self.bytes = 0
+
+	def report(self):
+		n = len(self.latencies)
+		rate = 0.
+		if self.elapsed > 0.: rate = n / self.elapsed
+		hit_rate = 0.
+		if n > 0: hit_rate = 100. * self.hits / n
+		print "%-6s %6d tiles %8.1f tiles/s  p50 %7.1f ms  p99 %7.1f ms  %9d bytes  hits %5.1f %%" % \
+			(self.name, n, rate, percentile(self.latencies, 50) * 1000., percentile(self.latencies, 99) * 1000.,
+			 self.bytes, hit_rate)
+
+def fetch(loader, tiles, workers, result, online=True):
+	"Requests the tiles with a number of worker threads"
+	queue = Queue.Queue()
+	for t in tiles: queue.put(t)
+	lock = threading.Lock()
+
+	def work():
+		while True:
+			try:	t = queue.get_nowait()
+			except Queue.Empty: return
+			start = time.time()
+			cached = os.path.exists(loader.tile_file(t[0], t[1], t[2]))
+			loader.get_tile(t[0], t[1], t[2], online)
+			lock.acquire()
+			result.latencies.append(time.time() - start)
+			if cached: result.hits += 1
+			lock.release()
+
+	start = time.time()
+	threads = [threading.Thread(target=work) for i in range(workers)]
+	for t in threads: t.start()
+	for t in threads: t.join()
+	result.elapsed += time.time() - start
+
+def screen_tiles(zoom, centre, width, height):
+	"The tiles a MapViewport of width x height around centre (in world pixels) loads"
+	tx = (int(centre[0]) - width / 2) / OSM_TILE_SIZE - 1
+	ty = (int(centre[1]) - height / 2) / OSM_TILE_SIZE - 1
+	tiles = []
+	for x in range(tx, tx + width / OSM_TILE_SIZE + 3):
+		for y in range(ty, ty + height / OSM_TILE_SIZE + 3):
+			tiles.append((zoom, x, y))
+	return tiles
+
+def new_loader(server, folder):
+	url = 'http://127.0.0.1:%d/%%d/%%d/%%d.png' % server.server_address[1]
+	return OSM_Loader(url, folder=folder)
+
+def cold_and_warm(server, options, folder):
+	loader = new_loader(server, folder)
+	x, y = OSM_deg2num(options.lat, options.lon, options.zoom)
+	tiles = []
+	for i in range(options.grid):
+		for j in range(options.grid):
+			tiles.append((options.zoom, x + i, y + j))
+
+	cold = Result('cold')
+	fetch(loader, tiles, options.workers, cold)
+	cold.bytes = loader.stats['bytes']
+
+	loader.clear_stats()
+	warm = Result('warm')
+	fetch(loader, tiles, options.workers, warm)
+	warm.bytes = loader.stats['bytes']
+	return [cold, warm]
+
+def ride_route(server, options, folder):
+	"Rides along a straight route, the map screen is drawn once per second"
+	loader = new_loader(server, folder)
+	prefetcher = OSM_Prefetcher(loader, options.prefetch_rate * options.time_scale, options.minutes,
+		idle = 0.5 / options.time_scale)
+	prefetcher.start()
+
+	# a route to the north east with one waypoint per 100 m
+	length = options.route_km * 1000.
+	m_per_deg = OSM_EARTH_CIRCUMFERENCE / 360.
+	route = []
+	for i in range(int(length / 100.) + 1):
+		d = i * 100. / math.sqrt(2.)
+		route.append((options.lat + d / m_per_deg, options.lon + d / (m_per_deg * math.cos(options.lat * math.pi / 180.))))
+
+	result = Result('route')
+	speed = options.speed / 3.6 # meters per second
+	start = time.time()
+	ride = 0.
+	while ride < length:
+		w = min(int(ride / 100.), len(route) - 1)
+		f = (ride - w * 100.) / 100.
+		nxt = route[min(w + 1, len(route) - 1)]
+		lat = route[w][0] + f * (nxt[0] - route[w][0])
+		lon = route[w][1] + f * (nxt[1] - route[w][1])
+		prefetcher.update(lat, lon, 45., speed, options.zoom, iter(route[w+1:]), w)
+
+		xy = OSM_deg2xy(lat, lon, options.zoom)
+		centre = (xy[0] * OSM_TILE_SIZE, xy[1] * OSM_TILE_SIZE)
+		fetch(loader, screen_tiles(options.zoom, centre, options.width, options.height), 1, result, online=False)
+
+		time.sleep(1. / options.time_scale)
+		ride += speed
+	prefetcher.stop(wait = True) # before the folder is deleted under a download
+	result.elapsed = time.time() - start
+	result.bytes = loader.stats['bytes']
+	return [result]
+
+def random_pan(server, options, folder):
+	loader = new_loader(server, folder)
+	xy = OSM_deg2xy(options.lat, options.lon, options.zoom)
+	centre = [xy[0] * OSM_TILE_SIZE, xy[1] * OSM_TILE_SIZE]
+	result = Result('pan')
+	for i in range(options.pans):
+		centre[0] += random.randint(-OSM_TILE_SIZE, OSM_TILE_SIZE)
+		centre[1] += random.randint(-OSM_TILE_SIZE, OSM_TILE_SIZE)
+		fetch(loader, screen_tiles(options.zoom, centre, options.width, options.height), options.workers, result)
+	result.bytes = loader.stats['bytes']
+	return [result]
+
+def main():
+	parser = OptionParser()
+	parser.add_option('--latency', type='float', default=100., help='server latency in ms')
+	parser.add_option('--bandwidth', type='int', default=0, help='bytes/s per connection, 0 = unlimited')
+	parser.add_option('--error-rate', type='float', default=0., help='fraction of failing requests')
+	parser.add_option('--tile-size', type='int', default=15000, help='bytes per tile')
+	parser.add_option('--workers', type='int', default=2, help='threads requesting tiles')
+	parser.add_option('--zoom', type='int', default=16)
+	parser.add_option('--lat', type='float', default=52.520727)
+	parser.add_option('--lon', type='float', default=13.409586)
+	parser.add_option('--grid', type='int', default=8, help='cold/warm: grid x grid tiles')
+	parser.add_option('--pans', type='int', default=50, help='pan: number of pans')
+	parser.add_option('--width', type='int', default=360, help='screen width')
+	parser.add_option('--height', type='int', default=640, help='screen height')
+	parser.add_option('--route-km', type='float', default=3.)
+	parser.add_option('--speed', type='float', default=30., help='route: km/h')
+	parser.add_option('--minutes', type='float', default=5., help='route: prefetch look ahead')
+	parser.add_option('--prefetch-rate', type='int', default=4096, help='route: prefetch bytes/s, 0 = unlimited')
+	parser.add_option('--time-scale', type='float', default=10., help='route: ride seconds per real second')
+	parser.add_option('--workloads', default='cold,route,pan', help='comma separated: cold (includes warm), route, pan')
+	options, args = parser.parse_args()
+
+	random.seed(1)
+	server = start_server(options)
+	workloads = {'cold' : cold_and_warm, 'route' : ride_route, 'pan' : random_pan}
+	for name in options.workloads.split(','):
+		folder = tempfile.mkdtemp(prefix='tiles_')
+		try:
+			for r in workloads[name](server, options, folder): r.report()
+		finally:
+			shutil.rmtree(folder)
+	server.shutdown()
+
+if __name__ == '__main__':
+	main()
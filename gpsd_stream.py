@@ -0,0 +1,153 @@
+# gpsd JSON reports for nmea_info.py on Linux
+#
+# Reads the TPV (fix) and SKY (satellites) reports of gpsd, or of a
+#  daemon speaking its protocol, instead of NMEA, and turns them into
+#  the updates of the python positioning module, which is what
+#  process_positioning_update wants:
+#
+#  stream = GpsdStream('localhost', 2947)
+#  reader = GpsdReader()
+#  ...
+#  for data in reader.feed(stream.read()): process_positioning_update(data)
+#
+# Reports are framed as they arrive, without waiting for line ends.
+#
+# GPL
+
+import time, calendar, json
+
+from nmea_stream import TcpStream
+
+NAN = float('nan')
+
+# Sent once connected, for reports in JSON
+WATCH = '?WATCH={"enable":true,"json":true};\n'
+
+class GpsdStream(TcpStream):
+	"""The connection to gpsd, which asks for JSON reports once it's up"""
+	def __init__(self, host = 'localhost', port = 2947):
+		TcpStream.__init__(self, host, port)
+
+	def connect(self):
+		if self.connected: return True
+		if not TcpStream.connect(self): return False
+		try:
+			self.sock.send(WATCH)
+		except Exception, inst:
+			self.failed(inst)
+			return False
+		return True
+
+def gpsd_time(text):
+	"""Seconds since 1970 of an ISO 8601 time like 2010-01-01T12:00:00.000Z,
+	None if there's none"""
+	if not text: return None
+	try:
+		seconds = calendar.timegm(time.strptime(text[:19], '%Y-%m-%dT%H:%M:%S'))
+	except ValueError:
+		return None
+	fraction = text[19:].rstrip('Z')
+	if fraction.startswith('.'):
+		try:	seconds += float(fraction)
+		except ValueError: pass
+	return seconds
+
+class GpsdReader:
+	"""Frames the JSON reports of gpsd, and keeps what SKY said for the
+	next fix. feed() returns the updates in the format of the python
+	positioning module."""
+	def __init__(self):
+		self.buffer = ''
+		self.decoder = json.JSONDecoder()
+		self.sky = None			# the last SKY report
+		self.stats = {'reports' : 0, 'broken' : 0}
+
+	def reports(self, chunk):
+		"""The complete JSON objects of the data so far"""
+		self.buffer += chunk
+		reports = []
+		buf = self.buffer
+		pos = 0
+		while True:
+			start = buf.find('{', pos)
+			if start == -1:
+				pos = len(buf)
+				break
+			try:
+				report, pos = self.decoder.raw_decode(buf, start)
+			except ValueError:
+				# Incomplete, or broken: then skip to the next line
+				end = buf.find('\n', start)
+				if end == -1:
+					pos = start
+					break
+				self.stats['broken'] += 1
+				pos = end + 1
+				continue
+			if isinstance(report, dict):
+				reports.append(report)
+				self.stats['reports'] += 1
+		self.buffer = buf[pos:]
+		return reports
+
+	def feed(self, chunk):
+		"""The updates of the TPV reports completed by chunk. Reports with
+		values of the wrong type are counted as broken and skipped."""
+		updates = []
+		for report in self.reports(chunk):
+			cls = report.get('class')
+			if cls == 'SKY':
+				self.sky = report
+			elif cls == 'TPV':
+				try:
+					updates.append(self.positioning_update(report))
+				except (ValueError, TypeError):
+					self.stats['broken'] += 1
+		return updates
+
+	def positioning_update(self, tpv):
+		"""A TPV report and the last SKY as an update of the positioning module"""
+		def value(report, *keys):
+			for key in keys:
+				if report.get(key) != None: return float(report[key])
+			return NAN
+
+		data = {}
+		if tpv.get('mode', 0) >= 2:
+			latitude = value(tpv, 'lat')
+			longitude = value(tpv, 'lon')
+		else:
+			latitude = longitude = NAN
+		eph = value(tpv, 'eph')
+		if eph != eph:
+			# The larger of the errors gpsd has, NaN if it has neither
+			errors = [e for e in (value(tpv, 'epx'), value(tpv, 'epy')) if e == e]
+			if errors: eph = max(errors)
+		data['position'] = {
+			'latitude' : latitude,
+			'longitude' : longitude,
+			'altitude' : value(tpv, 'altMSL', 'alt'),
+			'horizontal_accuracy' : eph,
+			'vertical_accuracy' : value(tpv, 'epv'),
+		}
+		data['course'] = {
+			'speed' : value(tpv, 'speed'),
+			'heading' : value(tpv, 'track'),
+		}
+
+		fix_time = gpsd_time(tpv.get('time'))
+		if fix_time == None: fix_time = time.time()
+		sats = {'satellites' : 0, 'used_satellites' : 0, 'time' : fix_time}
+		if self.sky != None and self.sky.get('satellites') != None:
+			in_view = []
+			in_use = []
+			for satellite in self.sky['satellites']:
+				prn = "%02d" % satellite.get('PRN', 0)
+				in_view.append(prn)
+				if satellite.get('used'): in_use.append(prn)
+			sats['satellites'] = len(in_view)
+			sats['used_satellites'] = len(in_use)
+			sats['in_view'] = in_view
+			sats['in_use'] = in_use
+		data['satellites'] = sats
+		return data
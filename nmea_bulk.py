@@ -0,0 +1,322 @@
+# Bulk NMEA parsing for the logs of nmea_info.py
+#
+# Reads whole NMEA files into numpy columns, one row per fix, for the
+#  offline analysis of recorded rides. Unlike NmeaParser, which keeps
+#  only the latest fix, every fix of the file is kept:
+#
+#  columns = parse_nmea_file('ride.nmea')
+#  print columns['speed'].mean(), columns['alt'].max()
+#
+# The checksums, the sentence IDs and the fields are extracted for all
+#  sentences at once with numpy, not line by line. Only sentences which
+#  start a line with '$' are read.
+#
+# Captures of gigabytes are split into byte ranges which are parsed by
+#  a pool of processes:
+#
+#  columns = parse_nmea_file('capture.nmea', processes = 4)
+#
+# Needs numpy, so it runs on a desktop python, not on the phone.
+#
+# GPL
+
+import os
+import numpy
+
+# The columns, and the value of a missing entry
+COLUMNS = {
+	'time' : numpy.nan,		# UTC, seconds since 1970 if the log has RMC dates, else since midnight of the first day
+	'lat' : numpy.nan,		# degrees, south negative
+	'lon' : numpy.nan,		# degrees, west negative
+	'alt' : numpy.nan,		# meters
+	'speed' : numpy.nan,	# meters per second
+	'heading' : numpy.nan,	# degrees
+	'hdop' : numpy.nan,
+	'satellites' : -1,		# satellites used
+	'quality' : -1			# GGA fix quality, 0 = no fix
+}
+
+# Bytes read beyond each end of a byte range, for the sentences of the
+#  fixes at the edges
+OVERLAP = 16384
+
+# Value of a hex digit by byte, -1 for other bytes
+HEX_VALUES = numpy.zeros(256, numpy.int16) - 1
+for i, c in enumerate('0123456789ABCDEF'):
+	HEX_VALUES[ord(c)] = HEX_VALUES[ord(c.lower())] = i
+del i, c
+
+def sentence_key(sentence_id):
+	"""The sentence ID ('GGA') as the number sentences() compares with"""
+	return (ord(sentence_id[0]) << 16) | (ord(sentence_id[1]) << 8) | ord(sentence_id[2])
+
+def sentences(data):
+	"""Finds the sentences in data (a string). Returns the arrays start
+	(of the fields after the sentence ID), end (of the fields, without
+	the checksum) and key (see sentence_key) of the sentences with a
+	correct or without a checksum, in file order. Any talker is taken,
+	like the GN of multi-constellation receivers."""
+	buf = numpy.frombuffer(data, numpy.uint8)
+	if len(buf) == 0 or buf[-1] != 10:
+		buf = numpy.frombuffer(data + '\n', numpy.uint8)
+
+	ends = numpy.flatnonzero(buf == 10)
+	starts = numpy.concatenate(([0], ends[:-1] + 1))
+	ends = ends - (buf[numpy.maximum(ends - 1, 0)] == 13) # strip \r
+
+	# $, a two letter talker, the sentence ID and the fields
+	ok = ends - starts >= 7
+	starts = starts[ok]
+	ends = ends[ok]
+	talker = (buf[starts + 1] >= 65) & (buf[starts + 1] <= 90) & (buf[starts + 2] >= 65) & (buf[starts + 2] <= 90)
+	ok = (buf[starts] == 36) & talker & (buf[starts + 6] == 44)
+	starts = starts[ok]
+	ends = ends[ok]
+
+	# Check the checksums, the XOR of everything between $ and *
+	has_checksum = (buf[ends - 3] == 42) & (ends - starts >= 10)
+	fields_end = numpy.where(has_checksum, ends - 3, ends)
+	bounds = numpy.empty(2 * len(starts), numpy.intp)
+	bounds[0::2] = starts + 1
+	bounds[1::2] = fields_end
+	if len(bounds):
+		checksum = numpy.bitwise_xor.reduceat(buf, bounds)[0::2]
+	else:
+		checksum = numpy.zeros(0, numpy.uint8)
+	expected = HEX_VALUES[buf[ends - 2]] * 16 + HEX_VALUES[buf[ends - 1]]
+	ok = ~has_checksum | (checksum == expected)
+
+	starts = starts[ok]
+	keys = (buf[starts + 3].astype(numpy.int32) << 16) | (buf[starts + 4].astype(numpy.int32) << 8) | buf[starts + 5]
+	return starts + 7, fields_end[ok], keys
+
+def fields(data, starts, ends, count):
+	"""The first count fields of the sentences data[starts[i]:ends[i]] as
+	a 2D array of strings. Sentences with fewer fields are dropped, the
+	second result says which were kept. Fields after the first count,
+	like the mode field NMEA 2.3 added to RMC and VTG, are ignored."""
+	lines = numpy.array([data[s:e] for s, e in zip(starts, ends)], dtype = str)
+	if len(lines) == 0:
+		return numpy.zeros((0, count), dtype = str), numpy.zeros(0, bool)
+	commas = numpy.char.count(lines, ',')
+	kept = commas >= count - 1
+	lines = lines[kept]
+	commas = commas[kept]
+	if len(lines) == 0:
+		return numpy.zeros((0, count), dtype = str), kept
+	table = numpy.array(','.join(lines).split(','), dtype = str)
+	if (commas == count - 1).all():
+		return table.reshape((len(lines), count)), kept
+	# Pick the first count fields of every sentence
+	first = numpy.concatenate(([0], numpy.cumsum(commas + 1)[:-1]))
+	return table[first[:,None] + numpy.arange(count)], kept
+
+def to_float(column):
+	"""A column of strings as floats, nan where empty or broken"""
+	try:
+		return numpy.where(column == '', 'nan', column).astype(float)
+	except ValueError:
+		values = numpy.empty(len(column))
+		for i in range(len(column)):
+			try:	values[i] = float(column[i])
+			except ValueError: values[i] = numpy.nan
+		return values
+
+def to_degrees(column, hemisphere, negative):
+	"""NMEA dddmm.mmmm strings and their hemisphere as degrees"""
+	value = to_float(column)
+	degrees = numpy.floor(value / 100.)
+	degrees = degrees + (value - degrees * 100.) / 60.
+	return numpy.where(hemisphere == negative, -degrees, degrees)
+
+def to_seconds(column):
+	"""NMEA hhmmss.ss strings as seconds since midnight"""
+	value = to_float(column)
+	hours = numpy.floor(value / 10000.)
+	minutes = numpy.floor(value / 100.) - hours * 100.
+	return hours * 3600. + minutes * 60. + (value - numpy.floor(value / 100.) * 100.)
+
+def unwrap_days(seconds):
+	"""Seconds since midnight counting on over midnight, as far as the order shows it"""
+	if len(seconds) == 0: return seconds
+	back = numpy.diff(seconds) < -43200.
+	return seconds + 86400. * numpy.concatenate(([0], numpy.cumsum(back)))
+
+def to_days(column):
+	"""NMEA ddmmyy dates as days since 1970, -1 where empty or broken"""
+	value = to_float(column)
+	good = ~numpy.isnan(value)
+	value = numpy.where(good, value, 10170).astype(int) # 01.01.70
+	day = value / 10000
+	month = (value / 100) % 100
+	year = value % 100
+	year = numpy.where(year < 80, year + 2000, year + 1900)
+	good &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+	months = numpy.where(good, (year - 1970) * 12 + month - 1, 0)
+	days = months.astype('datetime64[M]').astype('datetime64[D]').astype(int) + day - 1
+	return numpy.where(good, days, -1)
+
+def parse_nmea(data, first = 0, last = None):
+	"""Parses the NMEA sentences in data (a string) into a dictionary of
+	COLUMNS, with one row per GGA. Speed and heading come from the RMC
+	of the same time, or from the VTG after the GGA.
+	Only the GGAs which start between first and last make rows, the
+	data around them is just for their RMC and VTG."""
+	starts, ends, keys = sentences(data)
+	columns = {}
+	for name, missing in COLUMNS.items():
+		columns[name] = numpy.zeros(0, type(missing))
+
+	gga = keys == sentence_key('GGA')
+	table, kept = fields(data, starts[gga], ends[gga], 14)
+	n = len(table)
+	if n == 0:
+		return columns
+	gga_position = numpy.flatnonzero(gga)[kept]
+	gga_line = starts[gga][kept] - 7
+	tod = to_seconds(table[:,0])
+	seconds = unwrap_days(tod)
+	columns['lat'] = to_degrees(table[:,1], table[:,2], 'S')
+	columns['lon'] = to_degrees(table[:,3], table[:,4], 'W')
+	columns['quality'] = numpy.nan_to_num(to_float(table[:,5])).astype(int)
+	columns['satellites'] = numpy.where(table[:,6] == '', '-1', table[:,6]).astype(int)
+	columns['hdop'] = to_float(table[:,7])
+	columns['alt'] = to_float(table[:,8])
+	columns['speed'] = numpy.zeros(n) + numpy.nan
+	columns['heading'] = numpy.zeros(n) + numpy.nan
+	day = numpy.zeros(n, int) - 1
+
+	# VTG: the fix of the GGA before it
+	vtg = keys == sentence_key('VTG')
+	table, kept = fields(data, starts[vtg], ends[vtg], 8)
+	if len(table):
+		row = numpy.searchsorted(gga_position, numpy.flatnonzero(vtg)[kept]) - 1
+		use = row >= 0
+		columns['speed'][row[use]] = to_float(table[use,6]) / 3.6
+		columns['heading'][row[use]] = to_float(table[use,0])
+
+	# RMC: the fix of the GGA with the same time, and the date
+	rmc = keys == sentence_key('RMC')
+	table, kept = fields(data, starts[rmc], ends[rmc], 11)
+	if len(table):
+		rmc_seconds = unwrap_days(to_seconds(table[:,0]))
+		order = numpy.argsort(rmc_seconds, kind = 'mergesort')
+		rmc_seconds = rmc_seconds[order]
+		table = table[order]
+		row = numpy.minimum(numpy.searchsorted(rmc_seconds, seconds), len(rmc_seconds) - 1)
+		match = rmc_seconds[row] == seconds
+		speed = to_float(table[row,6]) * 0.514444
+		heading = to_float(table[row,7])
+		columns['speed'] = numpy.where(match & ~numpy.isnan(speed), speed, columns['speed'])
+		columns['heading'] = numpy.where(match & ~numpy.isnan(heading), heading, columns['heading'])
+		day = numpy.where(match, to_days(table[row,8]), -1)
+
+	# Seconds since 1970 where we know the day, from the last date before
+	if (day >= 0).any():
+		known = numpy.flatnonzero(day >= 0)
+		dated = known[numpy.maximum(numpy.searchsorted(known, numpy.arange(n), 'right') - 1, 0)]
+		base = day[dated] * 86400. - (seconds[dated] - tod[dated])
+		columns['time'] = base + seconds
+	else:
+		columns['time'] = seconds
+
+	if first > 0 or last != None:
+		if last == None: last = len(data)
+		rows = (gga_line >= first) & (gga_line < last)
+		for name in columns:
+			columns[name] = columns[name][rows]
+	return columns
+
+def concatenate_columns(parts):
+	"""Joins the columns of several parse_nmea results"""
+	columns = {}
+	for name, missing in COLUMNS.items():
+		columns[name] = numpy.concatenate([numpy.zeros(0, type(missing))] + [part[name] for part in parts])
+	return columns
+
+def merge_columns(parts):
+	"""Joins the columns of consecutive parts of one log in time order.
+	A part which starts over 12 hours before the previous one ended
+	is on the next day, for logs without dates."""
+	shift = 0.
+	last = None
+	for part in parts:
+		if len(part['time']) == 0: continue
+		if shift: part['time'] = part['time'] + shift
+		if last != None and part['time'][0] < last - 43200.:
+			part['time'] = part['time'] + 86400.
+			shift += 86400.
+		last = part['time'][-1]
+	columns = concatenate_columns(parts)
+	order = numpy.argsort(columns['time'], kind = 'mergesort')
+	for name in columns:
+		columns[name] = columns[name][order]
+	return columns
+
+def line_start(f, offset):
+	"""The offset of the first line of the file f which starts at or after offset"""
+	if offset <= 0: return 0
+	f.seek(offset - 1)
+	while True:
+		block = f.read(4096)
+		if not block: return f.tell()
+		i = block.find('\n')
+		if i >= 0: return f.tell() - len(block) + i + 1
+
+def byte_ranges(filename, count):
+	"""Splits the file into count (start, end) byte ranges of whole lines"""
+	size = os.path.getsize(filename)
+	f = open(filename, 'rb')
+	try:
+		bounds = [line_start(f, size * i / count) for i in range(count)] + [size]
+	finally:
+		f.close()
+	return [(bounds[i], bounds[i+1]) for i in range(count) if bounds[i] < bounds[i+1]]
+
+def parse_nmea_range(job):
+	"""The columns of the fixes whose GGA starts in the byte range of job,
+	a (filename, start, end). The whole lines up to OVERLAP bytes around
+	the range are read too, for the sentences of the fixes at the edges."""
+	filename, start, end = job
+	f = open(filename, 'rb')
+	try:
+		f.seek(max(0, start - OVERLAP))
+		data = f.read(end - start + 2 * OVERLAP)
+	finally:
+		f.close()
+
+	before = start - max(0, start - OVERLAP)
+	cut = 0
+	if before > 0:
+		cut = data.find('\n', 0, before) + 1 # a broken line, or the range start
+		if cut == 0: cut = before
+	if end - start + before < len(data):
+		data = data[:data.rfind('\n', end - start + before - 1) + 1]
+	return parse_nmea(data[cut:], before - cut, end - start + before - cut)
+
+def parse_nmea_file(filename, processes = 1, chunk_size = 64 << 20):
+	"""The columns of all fixes in the NMEA log filename. With more than
+	one process the file is split into ranges of about chunk_size
+	bytes, which are parsed by a pool of processes and merged in time
+	order."""
+	if processes <= 1 or os.path.getsize(filename) <= chunk_size:
+		f = open(filename, 'rb')
+		try:
+			return parse_nmea(f.read())
+		finally:
+			f.close()
+
+	import multiprocessing
+	count = max(processes, (os.path.getsize(filename) + chunk_size - 1) / chunk_size)
+	jobs = [(filename, start, end) for start, end in byte_ranges(filename, count)]
+	pool = multiprocessing.Pool(processes)
+	try:
+		parts = pool.map(parse_nmea_range, jobs, 1)
+	finally:
+		pool.close()
+		pool.join()
+	return merge_columns(parts)
+
+def parse_nmea_files(filenames, processes = 1):
+	"""The columns of all fixes in several logs, one after the other"""
+	return concatenate_columns([parse_nmea_file(filename, processes) for filename in filenames])
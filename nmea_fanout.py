@@ -0,0 +1,233 @@
+# Fan out of the GPS to many TCP clients, for nmea_info.py and trackside boxes
+#
+# Whoever holds the one connection to the GPS hands the sentences and
+#  fixes to a FanoutServer, which passes them on to all its clients, a
+#  logger, a live dashboard, a timing system, ...:
+#
+#  server = FanoutServer(('127.0.0.1', 10110))
+#  server.publish_sentence(update['raw'])	# for every sentence
+#  server.publish_fix(epoch)				# for every epoch
+#  server.service()							# often, it never blocks
+#
+# Clients get the raw sentences the parser took, unless they ask for
+#  something else by sending a line:
+#  ?FILTER=GGA,RMC   only these sentences, of any talker (blank = all)
+#  ?FIXES            one JSON object per fix instead of the sentences
+#  ?RAW              back to the sentences
+#
+# Every client has a bounded queue. When a client doesn't keep up, its
+#  oldest messages are dropped, the GPS reader is never held up.
+#
+# Standalone, reading the GPS with nmea_stream:
+#  python nmea_fanout.py --source serial:/dev/ttyUSB0:4800 --port 10110
+#
+# GPL
+
+import errno, socket, select
+
+# The fix fields sent to the clients which asked for ?FIXES
+FIX_FIELDS = ('time', 'lat', 'lon', 'alt', 'speed', 'heading', 'pdop', 'hdop', 'vdop', 'valid')
+
+# Errors of a send or receive which only mean "not now"
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+def fix_message(epoch):
+	"""The fix of an epoch (the updates of a NmeaParser) as a JSON line"""
+	fix = {}
+	for update in epoch:
+		if update.has_key('fix'): fix.update(update['fix'])
+	fields = []
+	for name in FIX_FIELDS:
+		value = fix.get(name)
+		if value == None or value != value:	fields.append('"%s":null' % name)
+		elif isinstance(value, float):		fields.append('"%s":%r' % (name, value))
+		else:								fields.append('"%s":%d' % (name, value))
+	return '{"class":"FIX",%s}\r\n' % ','.join(fields)
+
+class FanoutClient:
+	"""A connected client, with its queue and what it asked for"""
+	def __init__(self, sock, address, queue_size):
+		self.sock = sock
+		self.address = address
+		self.queue_size = queue_size
+		self.queue = []			# messages not sent yet, oldest first
+		self.sending = ''		# the rest of a message sent in part
+		self.commands = ''		# an incomplete command line
+		self.sentences = None	# sentence IDs to send, None = all
+		self.fixes = False		# send fixes instead of sentences
+		self.stats = {'sent' : 0, 'dropped' : 0}
+
+	def __repr__(self):
+		return "%s:%d" % self.address
+
+	def wants(self, sentence_id):
+		return not self.fixes and (self.sentences == None or self.sentences.has_key(sentence_id))
+
+	def put(self, message):
+		"""Queues a message, dropping the oldest one if the queue is full"""
+		if len(self.queue) >= self.queue_size:
+			del self.queue[0]
+			self.stats['dropped'] += 1
+		self.queue.append(message)
+
+	def command(self, line):
+		line = line.strip()
+		if line.upper().startswith('?FILTER='):
+			ids = [s.strip().upper()[-3:] for s in line[8:].split(',') if s.strip()]
+			if ids:
+				self.sentences = {}
+				for sentence_id in ids: self.sentences[sentence_id] = True
+			else:
+				self.sentences = None
+			self.fixes = False
+		elif line.upper() == '?FIXES':
+			self.fixes = True
+		elif line.upper() == '?RAW':
+			self.fixes = False
+
+	def receive(self):
+		"""Reads the commands of the client, returns False if it's gone"""
+		try:
+			data = self.sock.recv(1024)
+		except socket.error, inst:
+			return inst.args[0] in WOULD_BLOCK
+		if not data: return False
+		lines = (self.commands + data).split('\n')
+		self.commands = lines.pop()[-1024:]
+		for line in lines: self.command(line)
+		return True
+
+	def send(self):
+		"""Sends as much of the queue as the socket takes, returns False if
+		the client is gone"""
+		while self.sending or self.queue:
+			if not self.sending:
+				# Several messages at once, but not too many for the socket
+				count = min(len(self.queue), 64)
+				self.sending = ''.join(self.queue[:count])
+				del self.queue[:count]
+				self.stats['sent'] += count
+			try:
+				sent = self.sock.send(self.sending)
+			except socket.error, inst:
+				return inst.args[0] in WOULD_BLOCK
+			self.sending = self.sending[sent:]
+			if self.sending: return True
+		return True
+
+	def close(self):
+		self.sock.close()
+
+class FanoutServer:
+	"""Accepts TCP clients on address, and sends them the sentences and
+	fixes published to it. Nothing in here blocks."""
+	def __init__(self, address = ('127.0.0.1', 10110), queue_size = 256, max_clients = 16):
+		self.queue_size = queue_size
+		self.max_clients = max_clients
+		self.clients = []
+		self.stats = {'clients' : 0, 'sentences' : 0, 'fixes' : 0}
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listener.bind(address)
+		self.listener.listen(5)
+		self.listener.setblocking(0)
+		self.address = self.listener.getsockname()
+
+	def publish_sentence(self, raw):
+		"""Queues a sentence for the clients which want it"""
+		self.stats['sentences'] += 1
+		if not self.clients: return
+		raw = raw.rstrip() + '\r\n'
+		dollar = raw.rfind('$')
+		sentence_id = raw[dollar + 3:dollar + 6]
+		for client in self.clients:
+			if client.wants(sentence_id): client.put(raw)
+
+	def publish_fix(self, epoch):
+		"""Queues the fix of an epoch for the clients which want fixes"""
+		self.stats['fixes'] += 1
+		message = None
+		for client in self.clients:
+			if client.fixes:
+				if message == None: message = fix_message(epoch)
+				client.put(message)
+
+	def publish_epoch(self, epoch):
+		"""Queues the sentences and the fix of an epoch"""
+		for update in epoch:
+			if update.has_key('raw'): self.publish_sentence(update['raw'])
+		self.publish_fix(epoch)
+
+	def accept(self):
+		while True:
+			try:
+				sock, address = self.listener.accept()
+			except socket.error, inst:
+				return
+			if len(self.clients) >= self.max_clients:
+				sock.close()
+				continue
+			sock.setblocking(0)
+			self.clients.append(FanoutClient(sock, address, self.queue_size))
+			self.stats['clients'] += 1
+
+	def service(self, timeout = 0.):
+		"""Accepts new clients, reads their commands and sends their queues,
+		waiting up to timeout seconds for something to do"""
+		readers = [self.listener] + [client.sock for client in self.clients]
+		writers = [client.sock for client in self.clients if client.queue or client.sending]
+		try:
+			readable, writable = select.select(readers, writers, [], timeout)[:2]
+		except select.error, inst:
+			if inst.args[0] != errno.EINTR: raise
+			return
+
+		if self.listener in readable: self.accept()
+		gone = []
+		for client in self.clients:
+			if client.sock in readable and not client.receive():
+				gone.append(client)
+			elif client.sock in writable and not client.send():
+				gone.append(client)
+		for client in gone:
+			client.close()
+			self.clients.remove(client)
+
+	def close(self):
+		for client in self.clients: client.close()
+		self.clients = []
+		self.listener.close()
+
+def main():
+	from optparse import OptionParser
+	from nmea_stream import StreamPoller, open_stream
+	from nmea_parser import NmeaParser, EpochAssembler
+
+	parser = OptionParser()
+	parser.add_option('--source', default='tcp:localhost:10111', help='GPS: serial:/dev/ttyUSB0:4800, pty:/dev/pts/3 or tcp:host:port')
+	parser.add_option('--host', default='127.0.0.1', help='address to accept clients on')
+	parser.add_option('--port', type='int', default=10110)
+	parser.add_option('--queue', type='int', default=256, help='messages queued per client')
+	options, args = parser.parse_args()
+
+	server = FanoutServer((options.host, options.port), options.queue)
+	nmea = NmeaParser()
+	assembler = EpochAssembler()
+	def handle(stream, data):
+		for update in nmea.feed(data):
+			server.publish_sentence(update['raw'])
+			for epoch in assembler.add(update): server.publish_fix(epoch)
+
+	poller = StreamPoller()
+	poller.add(open_stream(options.source), handle)
+	print "Fanning out %s on %s:%d" % (options.source, server.address[0], server.address[1])
+	try:
+		while True:
+			poller.poll(0.05)
+			for epoch in assembler.expire(): server.publish_fix(epoch)
+			server.service(0.)
+	finally:
+		server.close()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,147 @@
+# Synthetic NMEA for nmea_info.py and friends
+#
+# Generates the sentences of a GPS moving along a route, or on a random
+#  walk, for load tests of the parser, the navigation and the screens:
+#
+#  generator = NmeaGenerator(route = [(52.52, 13.40), (52.53, 13.41)], rate = 10.)
+#  data = generator.epoch()	# GGA, GSA, GSV.., RMC and VTG of the next fix
+#
+# Every sentence has a correct checksum, unless it's corrupted on purpose.
+#
+# GPL
+
+import math, random, time
+
+from nmea_parser import generate_checksum
+
+# Meters per degree of latitude
+METERS_PER_DEGREE = 40075016.686 / 360.
+
+def nmea_sentence(data):
+	"""Adds the $, the checksum and the line end to data"""
+	return "$%s*%s\r\n" % (data, generate_checksum(data))
+
+def nmea_latlong(degrees, hemispheres, width):
+	"""Degrees as NMEA dddmm.mmmm, and the hemisphere"""
+	hemisphere = hemispheres[0]
+	if degrees < 0:
+		hemisphere = hemispheres[1]
+		degrees = -degrees
+	# Round to 0.0001 minutes first, so 59.99999 carries into the degrees
+	#  instead of being printed as 60.0000
+	ticks = int(round(degrees * 600000.))
+	return "%0*d%07.4f" % (width, ticks / 600000, (ticks % 600000) / 10000.), hemisphere
+
+class NmeaGenerator:
+	"""Moves along route (a list of (lat, long)) at speed meters per second,
+	or on a random walk from start if there is no route, and generates
+	rate epochs per second.
+	noise is the standard deviation of the position error in meters,
+	dropout the probability that a sentence is lost, corrupt the
+	probability that a sentence is garbled, satellites the number in view.
+	With mode the RMC and VTG end with the mode field of NMEA 2.3, with
+	gsv_last the GSVs come after the RMC and VTG, as some GPSs send them."""
+	def __init__(self, route = None, start = (51.5, -0.12), speed = 5., rate = 1.,
+			noise = 0., dropout = 0., corrupt = 0., satellites = 8, seed = None, mode = False, gsv_last = False):
+		self.route = route
+		self.speed = speed
+		self.rate = rate
+		self.noise = noise
+		self.dropout = dropout
+		self.corrupt = corrupt
+		self.satellites = satellites
+		self.mode = mode
+		self.gsv_last = gsv_last
+		self.random = random.Random(seed)
+
+		self.time = time.time()	# UTC time of the next epoch
+		self.leg = 0			# route: index of the waypoint we came from
+		self.heading = self.random.uniform(0., 360.)
+		if route: self.position = route[0]
+		else:     self.position = start
+
+		# A sky of satellites: prn, elevation, azimuth, snr
+		self.sky = []
+		for prn in self.random.sample(range(1, 33), min(32, satellites)):
+			self.sky.append((prn, self.random.randint(5, 90), self.random.randint(0, 359), self.random.randint(20, 50)))
+
+	def move(self, distance):
+		"""Moves us distance meters along the route, or on the random walk"""
+		lat, lon = self.position
+		while distance > 0.:
+			if self.route and len(self.route) > 1:
+				# Head for the next waypoint, start over at the end
+				if self.leg >= len(self.route) - 1:
+					self.leg = 0
+					lat, lon = self.route[0]
+				target = self.route[self.leg + 1]
+			else:
+				self.heading = (self.heading + self.random.gauss(0., 10.)) % 360.
+				target = None
+
+			if target == None:
+				step = distance
+			else:
+				dy = (target[0] - lat) * METERS_PER_DEGREE
+				dx = (target[1] - lon) * METERS_PER_DEGREE * math.cos(math.radians(lat))
+				step = math.hypot(dx, dy)
+				if step > 0.: self.heading = math.degrees(math.atan2(dx, dy)) % 360.
+				if step <= distance:
+					lat, lon = target
+					self.leg += 1
+					distance -= step
+					continue
+				step = distance
+
+			lat += step * math.cos(math.radians(self.heading)) / METERS_PER_DEGREE
+			lon += step * math.sin(math.radians(self.heading)) / (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+			distance = 0.
+		self.position = (lat, lon)
+
+	def sentences(self):
+		"""The sentences of the current position, without line ends"""
+		lat, lon = self.position
+		if self.noise > 0.:
+			lat += self.random.gauss(0., self.noise) / METERS_PER_DEGREE
+			lon += self.random.gauss(0., self.noise) / (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+		nlat, ns = nmea_latlong(lat, 'NS', 2)
+		nlon, ew = nmea_latlong(lon, 'EW', 3)
+
+		t = time.gmtime(self.time)
+		utc = "%02d%02d%02d.%02d" % (t[3], t[4], t[5], int(self.time * 100) % 100)
+		date = "%02d%02d%02d" % (t[2], t[1], t[0] % 100)
+		used = [s[0] for s in self.sky[:12]]
+		knots = self.speed / 0.514444
+
+		sentences = ["GPGGA,%s,%s,%s,%s,%s,1,%02d,0.9,%.1f,M,47.0,M,," % (utc, nlat, ns, nlon, ew, len(used), 50.)]
+		sentences.append("GPGSA,A,3,%s,1.8,0.9,1.5" % ','.join(["%02d" % prn for prn in used] + [''] * (12 - len(used))))
+		pages = max(1, (len(self.sky) + 3) / 4)
+		for page in range(pages):
+			sats = ["%02d,%02d,%03d,%02d" % s for s in self.sky[page * 4:page * 4 + 4]]
+			sentences.append("GPGSV,%d,%d,%02d,%s" % (pages, page + 1, len(self.sky), ','.join(sats)))
+		sentences.append("GPRMC,%s,A,%s,%s,%s,%s,%.1f,%.1f,%s,," % (utc, nlat, ns, nlon, ew, knots, self.heading, date))
+		sentences.append("GPVTG,%.1f,T,,M,%.1f,N,%.1f,K" % (self.heading, knots, self.speed * 3.6))
+		if self.mode:
+			sentences[-2] += ",A"	# autonomous
+			sentences[-1] += ",A"
+		if self.gsv_last:
+			sentences = sentences[:2] + sentences[-2:] + sentences[2:-2]
+		return sentences
+
+	def epoch(self):
+		"""The NMEA data of the next epoch, then moves on by one epoch"""
+		data = []
+		for sentence in self.sentences():
+			if self.dropout > 0. and self.random.random() < self.dropout:
+				continue
+			sentence = nmea_sentence(sentence)
+			if self.corrupt > 0. and self.random.random() < self.corrupt:
+				# Garble a character, or cut the sentence short
+				i = self.random.randint(1, len(sentence) - 3)
+				if self.random.random() < 0.5:	sentence = sentence[:i] + chr(self.random.randint(33, 126)) + sentence[i+1:]
+				else:							sentence = sentence[:i] + "\r\n"
+			data.append(sentence)
+
+		self.time += 1. / self.rate
+		self.move(self.speed / self.rate)
+		return ''.join(data)
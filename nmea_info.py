@@ -58,6 +58,7 @@ log_speed = None 	# log_file for place, speed values
 audio_info_on = True# if the speaker is eanbled
 waypoints_xy = None	# saves the current track as (x,y) coords
 track_xy = None		# saves the locations the users has passed
+route_version = 0	# bumped by route_changed whenever the waypoints are edited
 origin = [0,0]
 
 def write_settings(set):
@@ -188,6 +189,28 @@ def initialize_settings():
 	set_value(userpref,'min_direction_difference',10., 'float')  # min. 10 degrees denote a turning point, values below are irgnored, while searching the next turning point
 	set_value(userpref, 'skip_passed_waypoints', False, 'bool') # choose closest waypoint on track, always a wp was missed
 	set_value(pref,'use_db', False, 'bool') # save track in db
+	set_value(userpref,'map_online', True, 'bool') # download map tiles which are not stored on the phone
+	set_value(userpref,'map_zoom', 16, 'int') # largest zoom level used for the map
+	set_value(userpref,'prefetch_rate', 4096, 'int') # bytes per second used to download map tiles ahead of us, 0 = unlimited
+	set_value(userpref,'prefetch_minutes', 5., 'float') # download the map tiles needed in the next minutes
+	set_value(userpref,'epoch_sentence', '') # last NMEA sentence the GPS sends per fix, e.g. VTG, blank = find out
+	set_value(userpref,'nmea_sentences', '') # NMEA sentences to use, e.g. GGA,RMC,VTG, blank = all we know
+	set_value(userpref,'multi_gnss', False, 'bool') # also use the GN, GL, GA, ... talkers of multi-constellation receivers
+	set_value(userpref,'max_fix_rate', 5., 'float') # most fixes per second navigation and the screen run for, the others are only stored
+	set_value(userpref,'nmea_source', '') # NMEA from serial:/dev/ttyUSB0:4800, pty:/dev/pts/3 or tcp:host:port instead of the GPS, blank = none
+	set_value(userpref,'gpsd_source', '') # host:port of a gpsd to take the JSON fixes of instead of the GPS, blank = none
+	set_value(userpref,'fanout_port', 0, 'int') # TCP port to pass the GPS on to other programs of this box, 0 = off
+	set_value(userpref,'fanout_host', '127.0.0.1') # address the fan out accepts clients on, 0.0.0.0 = from anywhere on the network
+	set_value(userpref,'replay_file', '') # NMEA log to replay instead of using the GPS, blank = none
+	set_value(userpref,'replay_speed', 1., 'float') # 1 = real time, 10 = ten times faster, 0 = as fast as possible
+	set_value(userpref,'replay_start', '') # UTC time to start the replay at, as hh:mm:ss, blank = beginning
+	set_value(userpref,'synthetic_gps', False, 'bool') # generate fixes along the route instead of using the GPS, for load tests
+	set_value(userpref,'synthetic_rate', 1., 'float') # synthetic fixes per second, 1 - 100
+	set_value(userpref,'synthetic_speed', 5., 'float') # in meters per second
+	set_value(userpref,'synthetic_noise', 3., 'float') # standard deviation of the position in meters
+	set_value(userpref,'synthetic_dropout', 0., 'float') # probability that a sentence is lost
+	set_value(userpref,'synthetic_corrupt', 0., 'float') # probability that a sentence is garbled
+	set_value(userpref,'synthetic_satellites', 8, 'int') # satellites in view
 
 	return
 
@@ -262,6 +285,7 @@ class New_Destination_Form:
 
 			wp = (self.form[2][2], self.form[0][2],self.form[1][2]);
 			waypoints.append(wp)
+			route_changed()
 			current_waypoint = len(waypoints) - 1
 			print self.form[3]
 			if self.form[3][2][1] == 0 : # save in database
@@ -461,10 +485,23 @@ except ImportError:
 	sys.excepthook=None
 	sys.exit()
 
+try:
+	from nmea_parser import *
+except ImportError:
+	appuifw.note(u"nmea_parser.py module wasn't found!", "error")
+	print "\n"
+	print "Error: nmea_parser.py module wasn't found\n"
+	print "Please install it next to nmea_info.py, before using program"
+	# Try to exit without a stack trace - doesn't always work!
+	sys.__excepthook__=None
+	sys.excepthook=None
+	sys.exit()
+
 try:
 	from OSM import *# support for Open Street Maps
 	has_OSM = True
 	Map = OSM_Loader(folder=userpref['base_dir'])
+	prefetcher = OSM_Prefetcher(Map, userpref['prefetch_rate'], userpref['prefetch_minutes'])
 except ImportError:
 	appuifw.note(u"OSM.py module wasn't found! Necessary for Open street map support. ", "error")
 	has_OSM = False
@@ -488,6 +525,38 @@ except SymbianError:
 	# Will alert them later on
 	has_camera = False
 
+# Only needed for load tests
+has_generator = None
+try:
+	from nmea_generator import *
+	has_generator = True
+except ImportError:
+	has_generator = False
+
+# Only on Linux, for serial, pty and TCP sources
+has_stream = None
+try:
+	from nmea_stream import *
+	has_stream = True
+except ImportError:
+	has_stream = False
+
+# Also only on Linux, for fixes from gpsd
+has_gpsd = None
+try:
+	from gpsd_stream import *
+	has_gpsd = True
+except ImportError:
+	has_gpsd = False
+
+# For passing the GPS on to other programs
+has_fanout = None
+try:
+	from nmea_fanout import *
+	has_fanout = True
+except ImportError:
+	has_fanout = False
+
 # But positioning is built in
 has_positioning = None
 try:
@@ -523,59 +592,148 @@ if not os.path.exists(userpref['base_dir']+'maps\\'):
 #############################################################################
 
 class mean_value:
-	"compute the mean value of a set of values. Only a maximum of values is used (moving average). "
+	"""compute the mean value of a set of values. Only a maximum of values is used (moving average).
+	The mean and the squared deviations are updated per value (Welford), and worked out
+	again from the values every max updates, so rounding errors can't pile up."""
 	def __init__(self, max_values = 10):
 		self.max = max_values
 		self.val = []
-		self.squ = []
 		self.items = 0
+		self.avg = 0.		# mean of val
+		self.m2 = 0.		# sum of the squared deviations of val from avg
+		self.updates = 0	# since avg and m2 were last worked out from val
 
 	def append(self, value):
 		if self.items < self.max:
-			self.val.append(value)
-			self.squ.append(value*value)
 			self.items += 1
+			delta = value - self.avg
+			self.avg += delta / self.items
+			self.m2 += delta * (value - self.avg)
 		else:
-			del self.val[0]
-			del self.squ[0]
-			self.val.append(value)
-			self.squ.append(value*value)
+			old = self.val.pop(0)
+			avg = self.avg + (value - old) / self.items
+			self.m2 += (value - old) * (value - avg + old - self.avg)
+			self.avg = avg
+		self.val.append(value)
+		self.updates += 1
+		if self.updates >= self.max: self.recompute()
+
+	def recompute(self):
+		self.updates = 0
+		if self.items == 0:
+			self.avg = self.m2 = 0.
+			return
+		sum = 0.
+		for i in self.val: sum += i
+		self.avg = sum / self.items
+		sum = 0.
+		for i in self.val: sum += (i - self.avg) * (i - self.avg)
+		self.m2 = sum
 
 	def mean(self):
 		if self.items == 0: return None
-		sum = 0
-		for i in self.val:
-			sum += i
-		sum /= float(self.items)
-		return float(sum)
+		return self.avg
 
 	def stddev(self):
 		if self.items == 0: return None
-		sum = 0
-		for i in self.squ:	sum += i
-		sum /= float(self.items)
-		mean = self.mean()
-		return float(sum) - mean*mean
+		return max(0., self.m2 / self.items)
 
 	def resize(self, new_max):
 		"Sets a new size for a new max value"
 		self.max = new_max
 		if self.items <= self.max:
 			return
-		elif self.items > self.max:
-			while len(self.val) > self.max: del self.val[0]
-		return
+		del self.val[:self.items - self.max]
+		self.items = self.max
+		self.recompute()
 
 	def clear(self):
 		self.items = 0
-		del self.val
 		self.val = []
+		self.recompute()
+
+
+class rolling_distribution:
+	"the last values of something, for their percentiles"
+	def __init__(self, max_values = 300):
+		self.max = max_values
+		self.val = []
+		self.next = 0	# where the next value goes once val is full
+
+	def append(self, value):
+		if len(self.val) < self.max:
+			self.val.append(value)
+		else:
+			self.val[self.next] = value
+			self.next = (self.next + 1) % self.max
 
+	def percentile(self, p):
+		if not self.val: return None
+		val = self.val[:]
+		val.sort()
+		return val[min(len(val) - 1, int(len(val) * p / 100.))]
 
 info = {} # used to store a lot of information
 info['position_lat_avg'] = mean_value(10)
 info['position_long_avg'] = mean_value(10)
 info['speed_avg'] = mean_value(20)
+info['fix_age'] = rolling_distribution()		# seconds from the GPS time of a fix to drawing it
+info['fix_latency'] = rolling_distribution()	# seconds from reading a fix to drawing it
+
+# Seconds the averages span, they hold this many fixes at one fix a second
+AVERAGE_SECONDS = {'position_lat_avg' : 10, 'position_long_avg' : 10, 'speed_avg' : 20}
+
+# The measured fix rate, and when the next fix is due for navigation
+fix_rate = {'rate' : 1., 'fixes' : 0, 'since' : None, 'due' : 0.}
+
+def record_fix_timing():
+	"""Stamps the fix as drawn, and keeps how old it was and how long we
+	took. The age includes how far the phone clock is off the GPS."""
+	fix.drawn = time.time()
+	if fix.gps_time != None: info['fix_age'].append(now() - fix.gps_time)
+	if fix.arrived != None: info['fix_latency'].append(fix.drawn - fix.arrived)
+
+def fix_timing_text():
+	"""The medians and 95th percentiles of the fix age and latency"""
+	age = info['fix_age']
+	latency = info['fix_latency']
+	if not age.val and not latency.val: return None
+	text = ''
+	if age.val:
+		text = "%.1f/%.1f s  " % (age.percentile(50), age.percentile(95))
+	if latency.val:
+		text += "lag %d/%d ms" % (latency.percentile(50) * 1000, latency.percentile(95) * 1000)
+	return text
+
+def fixes_due(fixes):
+	"""Counts the new fixes, returns True if they are due for navigation
+	and drawing, which run at most max_fix_rate times a second so the
+	CPU used doesn't grow with the fix rate. The averages are resized to
+	span the same seconds at the rate they get fixes. Both go by the
+	parser clock, which a replay runs at the time of its log."""
+	t = now()
+	if fix_rate['since'] == None or t < fix_rate['since']:
+		# Started, or the clock went back, like a replay seeking
+		fix_rate['since'] = t
+		fix_rate['fixes'] = 0
+		fix_rate['due'] = 0.
+	fix_rate['fixes'] += fixes
+	if t - fix_rate['since'] >= 5.:
+		rate = fix_rate['fixes'] / (t - fix_rate['since'])
+		fix_rate['fixes'] = 0
+		fix_rate['since'] = t
+		if userpref['max_fix_rate'] > 0: rate = min(rate, userpref['max_fix_rate'])
+		rate = max(1., rate)
+		if abs(rate - fix_rate['rate']) >= 0.5:
+			fix_rate['rate'] = rate
+			for key in AVERAGE_SECONDS.keys():
+				info[key].resize(int(AVERAGE_SECONDS[key] * rate + 0.5))
+
+	if userpref['max_fix_rate'] <= 0: return True
+	if t < fix_rate['due']: return False
+	# A little early is fine, the fixes don't arrive like clockwork
+	fix_rate['due'] = t + 0.9 / userpref['max_fix_rate']
+	return True
 info['overall_distance'] = 0.
 
 def format_distance(value):
@@ -676,7 +834,7 @@ def set_audio_alert_placetime():
 	global place_of_last_audio_alert
 	global time_last_audio_message
 	global info
-	time_last_audio_message = time.time()
+	time_last_audio_message = now()
 	#wgs_ll = get_latlong_floats()
 	#if wgs_ll != None:
 	if info.has_key('avg_position') and info['avg_position'] != None:
@@ -789,12 +947,19 @@ def select_closest_waypoint():
 	appuifw.note(u"Closest waypoint is %d." % current_waypoint, 'info')
 	return
 
+def route_changed():
+	"""Call after the waypoints were edited, so what was drawn from them
+	is drawn again"""
+	global route_version
+	route_version += 1
+
 def reverse_track():
 	"""Reverses the track and computes the right index of the current
 	waypoint"""
 	global current_waypoint
 	global waypoints
 	waypoints.reverse()
+	route_changed()
 	old = current_waypoint
 	diff = len(waypoints) - 1 - current_waypoint
 	current_waypoint = diff
@@ -966,7 +1131,7 @@ def speech_timer():
 			# alert when direction is totally wrong and distance from last point is larger than 40m
 			elif audio_info_on and info.has_key('speed_avg') and info['speed_avg'].items > 0 \
 				and info['speed_avg'].mean() > userpref['minimum_speed_mps'] and info.has_key('proposed_direction') \
-				and (time.time() - time_last_audio_message) >= userpref['audio_alert_interval']:
+				and (now() - time_last_audio_message) >= userpref['audio_alert_interval']:
 				wgs_ll = get_latlong_floats();
 				if wgs_ll != None and place_of_last_audio_alert != None:
 					try:
@@ -984,7 +1149,7 @@ def speech_timer():
 						else:
 							if dir > 40. and dir < 320.: audio_direction_info() # alert if the actual direction is bad
 
-			elif audio_info_on and (time.time() - time_last_audio_message) > userpref['audio_info_interval']: # normal audio alert interval
+			elif audio_info_on and (now() - time_last_audio_message) > userpref['audio_info_interval']: # normal audio alert interval
 				audio_info() #
 
 		except SymbianError, e :		# if speaking is not allowed at the moment
@@ -1058,6 +1223,7 @@ def delete_current_waypoint():
 	for waypoint in waypoints:
 		if waypoint[0] == name:
 			waypoints.remove(waypoint)
+	route_changed()
 	current_waypoint = 0
 
 	# Delete from the db
@@ -1136,6 +1302,7 @@ def import_gpx_track(filename=None):
 			waypoints.append( (desc,lat,lon) )
 
 	del trackpt
+	route_changed()
 	current_waypoint = 0
 	appuifw.note(u'Gpx track imported : %d waypoints.'% (len(waypoints)),"info")
 
@@ -1178,8 +1345,11 @@ waypoints_xy = Track(waypoints)
 #############################################################################
 
 # Our current location
-location = {}
+location = LocationState()
 location['valid'] = 1 # Default to valid, in case no GGA/GLL sentences
+# The same as numbers
+fix = Fix()
+fanout = None	# FanoutServer the epochs are passed on to, if fanout_port is set
 # Our current motion
 motion = {}
 # What satellites we're seeing
@@ -1205,24 +1375,6 @@ speaking = False
 
 #############################################################################
 
-# Generate the checksum for some data
-# (Checksum is all the data XOR'd, then turned into hex)
-def generate_checksum(data):
-	"""Generate the NMEA checksum for the supplied data"""
-	csum = 0
-	for c in data:
-		csum = csum ^ ord(c)
-	hex_csum = "%02x" % csum
-	return hex_csum.upper()
-
-# Format a NMEA timestamp into something friendly
-def format_time(time):
-	"""Generate a friendly form of an NMEA timestamp"""
-	hh = time[0:2]
-	mm = time[2:4]
-	ss = time[4:]
-	return "%s:%s:%s UTC" % (hh,mm,ss)
-
 # Format a NMEA date into something friendly
 def format_date(date):
 	"""Generate a friendly form of an NMEA date"""
@@ -1295,70 +1447,9 @@ def user_format_latlong(lat,long):
 			flong += "E"
 	return (flat,flong)
 
-# NMEA data is HHMM.nnnn where nnnn is decimal part of second
-def format_latlong(data):
-	"""Turn HHMM.nnnn into HH:MM.SS"""
-
-	# Check to see if it's HMM.nnnn or HHMM.nnnn or HHHMM.nnnn
-	if data[5:6] == '.':
-		# It's HHHMM.nnnn
-		hh_mm = data[0:3] + ":" + data[3:5]
-		dddd = data[6:]
-	elif data[3:4] == '.':
-		# It's HMM.nnnn
-		hh_mm = data[0:1] + ":" + data[1:3]
-		dddd = data[4:]
-	else:
-		# Assume HHMM.nnnn
-		hh_mm = data[0:2] + ":" + data[2:4]
-		dddd = data[5:]
-
-	# Turn from decimal into seconds, and strip off last 2 digits
-	sec = int( float(dddd) / 100.0 * 60.0 / 100.0 )
-	return hh_mm + ":" + str(sec)
-
-def format_latlong_dec(data):
-	"""Turn HHMM.nnnn into HH.ddddd"""
-
-	# Check to see if it's HMM.nnnn or HHMM.nnnn or HHHMM.nnnn
-	if data[5:6] == '.':
-		hours = data[0:3]
-		mins = float(data[3:])
-	elif data[3:4] == '.':
-		hours = data[0:1]
-		mins = float(data[1:])
-	else:
-		hours = data[0:2]
-		mins = float(data[2:])
-
-	dec = mins / 60.0 * 100.0
-	# Cap at 6 digits - currently nn.nnnnnnnn
-	dec = dec * 10000.0
-	str_dec = "%06d" % dec
-	return hours + "." + str_dec
-
 def get_latlong_floats():
-	"Removes N/S E/W and replace S and W by '-' "
-	global location
-	if not location.has_key('lat_dec') or not location.has_key('long_dec'):
-		return None
-
-	if location['valid'] == 0: return None
-
-	wgs_lat = location['lat_dec'];
-	wgs_long = location['long_dec'];
-	if wgs_lat[-1:] == 'S':
-		wgs_lat = '-' + wgs_lat;
-	if wgs_long[-1:] == 'W':
-		wgs_long = '-' + wgs_long;
-
-	#print wgs_lat, wgs_long
-	try:
-		wgs_lat = float(wgs_lat[0:-1])
-		wgs_long = float(wgs_long[0:-1])
-	except ValueError:
-		return None
-	return (wgs_lat,wgs_long)
+	"(lat, long) of a valid fix, with S and W negative, otherwise None"
+	return fix.latlong()
 
 def dist_tupel_to_floats(dist):
 
@@ -1378,147 +1469,41 @@ def dist_tupel_to_floats(dist):
 
 #############################################################################
 
-def readline(sock):
-	"""Read one single line from the socket"""
-	line = ""
-	while 1:
-		char = sock.recv(1)
-		if not char: break
-		line += char
-		if char == "\n": break
-	return line
-
-#############################################################################
-
-def do_gga_location(data):
-	"""Get the location from a GGA sentence"""
-	global location
-
-	# TODO: Detect if we're not getting speed containing sentences, but
-	#		we are geting location ones, so we need to compute the speed
-	#		for ourselves
-
-	d = data.split(',')
-	location['type'] = 'GGA'
-	location['lat'] = "%s%s" % (format_latlong(d[1]),d[2])
-	location['long'] = "%s%s" % (format_latlong(d[3]),d[4])
-	location['lat_dec'] = "%s%s" % (format_latlong_dec(d[1]),d[2])
-	location['long_dec'] = "%s%s" % (format_latlong_dec(d[3]),d[4])
-	location['lat_raw'] = "%s%s" % (d[1],d[2])
-	location['long_raw'] = "%s%s" % (d[3],d[4])
-	location['alt'] = "%s %s" % (d[8],d[9])
-	location['time'] = format_time(d[0])
-	location['tsecs'] = long(time.time())
-	if d[5] == '0':
-		location['valid'] = 0
-	else:
-		location['valid'] = 1
-
-def do_gll_location(data):
-	"""Get the location from a GLL sentence"""
-	global location
-
-	d = data.split(',')
-	location['type'] = 'GLL'
-	location['lat'] = "%s%s" % (format_latlong(d[0]),d[1])
-	location['long'] = "%s%s" % (format_latlong(d[2]),d[3])
-	location['lat_dec'] = "%s%s" % (format_latlong_dec(d[0]),d[1])
-	location['long_dec'] = "%s%s" % (format_latlong_dec(d[2]),d[3])
-	location['lat_raw'] = "%s%s" % (d[0],d[1])
-	location['long_raw'] = "%s%s" % (d[2],d[3])
-	location['time'] = format_time(d[4])
-	if d[5] == 'A':
-		location['valid'] = 1
-	elif d[5] == 'V':
-		location['valid'] = 0
-
-def do_rmc_location(data):
-	"""Get the location from a RMC sentence"""
+def apply_nmea_epoch(epoch, parser = None):
+	"""Store the updates of an epoch, and pass them on to the fan out clients"""
+	if epoch: fix.arrived = epoch[0].get('arrived')
+	for update in epoch:
+		try:
+			apply_nmea_update(update)
+		# Catch exceptions cased by the GPS sending us crud
+		except NMEA_ERRORS, inst:
+			if parser != None: parser.count_exception(inst)
+			debug_log("EXCEPTION: %s" % str(inst))
+	if fanout != None:
+		fanout.publish_epoch(epoch)
+
+def publish_fix():
+	"""Pass the fix on to the fan out clients which asked for ?FIXES, for
+	the sources which have no NMEA sentences to pass on"""
+	if fanout != None:
+		values = {}
+		for name in FIX_FIELDS: values[name] = getattr(fix, name)
+		fanout.publish_fix([{'fix' : values}])
+
+def apply_nmea_update(update):
+	"""Store an update of the NmeaParser in our location, satellites and motion"""
 	global location
-
-	d = data.split(',')
-	location['type'] = 'RMC'
-	location['lat'] = "%s%s" % (format_latlong(d[2]),d[3])
-	location['long'] = "%s%s" % (format_latlong(d[4]),d[5])
-	location['lat_dec'] = "%s%s" % (format_latlong_dec(d[2]),d[3])
-	location['long_dec'] = "%s%s" % (format_latlong_dec(d[4]),d[5])
-	location['lat_raw'] = "%s%s" % (d[2],d[3])
-	location['long_raw'] = "%s%s" % (d[4],d[5])
-	location['time'] = format_time(d[0])
-
-#############################################################################
-
-def do_gsv_satellite_view(data):
-	"""Get the list of satellites we can see from a GSV sentence"""
 	global satellites
-	d = data.split(',')
-
-	# Are we starting a new set of sentences, or continuing one?
-	full_view_in = d[0]
-	sentence_no = d[1]
-	tot_in_view = d[2]
-
-	if int(sentence_no) == 1:
-		satellites['building_list'] = []
-
-	# Loop over the satellites in the sentence, grabbing their data
-	sats = d[3:]
-	while len(sats) > 0:
-		prn_num = sats[0]
-		elevation = float(sats[1])
-		azimuth = float(sats[2])
-		sig_strength = float(sats[3])
-
-		satellites[prn_num] = {
-			'prn':prn_num,
-			'elevation':elevation,
-			'azimuth':azimuth,
-			'sig_strength':sig_strength
-		}
-
-		satellites['building_list'].append(prn_num)
-		sats = sats[4:]
-
-	# Have we got all the details from this set?
-	if sentence_no == full_view_in:
-		satellites['in_view'] = satellites['building_list']
-		satellites['in_view'].sort()
-		satellites['building_list'] = []
-	# All done
-
-def do_gsa_satellites_used(data):
-	"""Get the list of satellites we are using to get the fix"""
-	global satellites
-	d = data.split(',')
-
-	sats = d[2:13]
-	overall_dop = d[14]
-	horiz_dop = d[15]
-	vert_dop = d[16]
-
-	while (len(sats) > 0) and (not sats[-1]):
-		sats.pop()
-
-	satellites['in_use'] = sats
-	satellites['in_use'].sort()
-	satellites['overall_dop'] = overall_dop
-	satellites['horiz_dop'] = horiz_dop
-	satellites['vert_dop'] = vert_dop
-
-def do_vtg_motion(data):
-	"""Get the current motion, from the VTG sentence"""
 	global motion
-	d = data.split(',')
 
-	if not len(d[6]):
-		d[6] = 0.0
-	motion['speed_kmph'] = float(d[6])
-	motion['speed_mph'] = float(d[6]) / 1.609344
-	motion['true_heading'] = d[0]
+	if update.has_key('location'):		location.update(update['location'])
+	if update.has_key('satellites'):	satellites.update(update['satellites'])
+	if update.has_key('motion'):		motion.update(update['motion'])
+	if update.has_key('fix'):			fix.update(update['fix'])
 
-	motion['mag_heading'] = ''
-	if d[2] and int(d[2]) > 0:
-		motion['mag_heading'] = d[2]
+	# Log GGA packets periodically
+	if update['sentence'] == 'GGA':
+		save_gga_log(update['raw'])
 
 #############################################################################
 def process_positioning_update(data):
@@ -1529,6 +1514,7 @@ def process_positioning_update(data):
 	global gps
 
 	latlong = (0,0)
+	fix.arrived = time.time()
 
 	if data.has_key("position"):
 		pos = data["position"]
@@ -1539,48 +1525,67 @@ def process_positioning_update(data):
 		if str(pos["latitude"]).lower() == 'nan':
 			location['lat_dec'] = None
 			location['valid'] = 0
+			fix.lat = None
 		else:
 			location['lat_dec'] = "%02.6f" % pos["latitude"]
 			location['valid'] = 1
+			fix.lat = pos["latitude"]
+		fix.valid = location['valid']
 
 		if str(pos["longitude"]).lower() == 'nan':
 			location['long_dec'] = None
+			fix.lon = None
 		else:
 			location['long_dec'] = "%02.6f" % pos["longitude"]
+			fix.lon = pos["longitude"]
 
 		location['alt'] = "%3.1f m" % (pos["altitude"])
+		fix.alt = pos["altitude"]
 
 		satellites['horiz_dop'] = "%0.1f" % pos["horizontal_accuracy"]
 		satellites['vert_dop'] = "%0.1f"  % pos["vertical_accuracy"]
 		satellites['overall_dop'] = "%0.1f" % ((pos["horizontal_accuracy"]+pos["vertical_accuracy"])/2)
+		fix.hdop = pos["horizontal_accuracy"]
+		fix.vdop = pos["vertical_accuracy"]
+		fix.pdop = (pos["horizontal_accuracy"]+pos["vertical_accuracy"])/2
 
 	if data.has_key("course"):
 		cor = data["course"]
 		if str(cor["speed"]).lower() == 'nan':
 			if motion.has_key('speed'):
 				del motion['speed']
+			fix.speed = None
 		else:
 			# symbian gps speed is in meters per second
 			mps = cor["speed"]
 			motion['speed'] = mps
+			fix.speed = mps
 			motion['speed_kmph'] = mps / 1000.0 * 60 * 60
 			motion['speed_mph'] = motion['speed_kmph'] / 1.609344
 
 		if str(cor["heading"]).lower() == 'nan':
 			if motion.has_key('true_heading'): del motion['true_heading']
 			if motion.has_key('heading'): del motion['heading']
+			fix.heading = None
 		else:
 			motion['heading'] = cor['heading']
+			fix.heading = cor['heading']
 			motion['true_heading'] = "%0.1f" % cor["heading"]
 
 	if data.has_key("satellites"):
 		sats = data["satellites"]
 		#print sats
-		# We don't yet get data on the satellites, just the numbers
-		satellites['in_view'] = ["??" for prn in range(sats['satellites'])]
-		satellites['in_use']  = ["??" for prn in range(sats['used_satellites'])]
+		if sats.has_key('in_view'):
+			# gpsd tells us which they are
+			satellites['in_view'] = sats['in_view']
+			satellites['in_use']  = sats['in_use']
+		else:
+			# We don't yet get data on the satellites, just the numbers
+			satellites['in_view'] = ["??" for prn in range(sats['satellites'])]
+			satellites['in_use']  = ["??" for prn in range(sats['used_satellites'])]
 
 		location['tsecs'] = sats["time"]
+		fix.gps_time = sats["time"]
 		try:
 			timeparts = time.gmtime( location['tsecs'] )
 		except ValueError:
@@ -1588,6 +1593,7 @@ def process_positioning_update(data):
 
 		if timeparts == None: return
 		location['time'] = "%02d:%02d:%02d" % (timeparts[3:6])
+		fix.time = timeparts[3] * 3600 + timeparts[4] * 60 + timeparts[5]
 		location['date'] = format_date_from_parts(*timeparts[0:3])
 
 		return
@@ -1614,6 +1620,10 @@ class LogFile:
 			self.file.close()
 			self.file = None
 
+	def flush(self):
+		"""Writes what is buffered, so the file can be read while it's open"""
+		if self.file != None: self.file.flush()
+
 	def set_new_filename(self):
 		datetimestr = time.strftime(self.name + "_%Y%m%d_%H%M%S.log", time.localtime(time.time()))
 		self.fullpath = os.path.join(self.path, datetimestr)
@@ -1778,13 +1788,14 @@ def compute_positional_data():
 		if place_of_last_audio_alert == None: place_of_last_audio_alert = info['avg_position']
 
 		def do_log(pos):
-			if not info.has_key('last_log_time'): info['last_log_time'] = time.time()
-			if time.time() - info['last_log_time'] > float(userpref['log_interval']):
+			if not info.has_key('last_log_time'): info['last_log_time'] = now()
+			if now() - info['last_log_time'] > float(userpref['log_interval']):
 				if userpref['log_simple']:
 					log_track.log([time.strftime("%d.%m.%Y_%H:%M:%S", time.localtime()), pos[0], pos[1]])
 				else:
 					save_gga_log()
-				info['last_log_time'] = time.time()
+				if route_overlay != None: route_overlay.append_track(pos[0], pos[1])
+				info['last_log_time'] = now()
 
 			stddev = 0.5 * (info['position_lat_avg'].stddev() + info['position_long_avg'].stddev())
 			speed = info['speed_avg'].mean()
@@ -1812,25 +1823,56 @@ def compute_positional_data():
 				do_log(info['avg_position'])# log the track to a file
 
 	# moving average of speed
-	if motion.has_key('speed') :
-		info['speed_mps'] = motion['speed']
-		info['speed_avg'].append(motion['speed'])
+	if fix.speed != None:
+		info['speed_mps'] = fix.speed
+		info['speed_avg'].append(fix.speed)
 	else:
 		info['speed_avg'].append(0.)
 
-	if motion.has_key('true_heading') and info['speed_avg'].mean() > userpref['minimum_speed_mps']:
-		info['avg_heading']  =  float(motion['true_heading'])
-	elif motion.has_key('true_heading') and info.has_key('d_heading'):
-		act_heading = float(motion['true_heading'])
+	if fix.heading != None and info['speed_avg'].mean() > userpref['minimum_speed_mps']:
+		info['avg_heading']  =  fix.heading
+	elif fix.heading != None and info.has_key('d_heading'):
+		act_heading = fix.heading
 		info['avg_heading']  = 1./6. *( 5. * info['d_heading'] + act_heading)
-	elif not motion.has_key('true_heading') and info.has_key('d_heading'):
+	elif fix.heading == None and info.has_key('d_heading'):
 		info['avg_heading'] = info['d_heading']
 	else:
 		try: del info['avg_heading']
 		except: pass
 
+	prefetch_map_tiles()
 
 	return 1 # redraw by default
+
+def prefetch_map_tiles():
+	"Tells the prefetcher where we are and where we are going"
+	if not has_OSM or not userpref['map_online']: return
+
+	wgs_ll = get_latlong_floats()
+	if wgs_ll == None: return
+
+	def remaining_waypoints():
+		for w in range(current_waypoint, len(waypoints)):
+			try:	yield (float(waypoints[w][1]), float(waypoints[w][2]))
+			except ValueError: continue
+
+	route = None
+	route_id = None
+	if current_waypoint != None and len(waypoints) > 0:
+		route = remaining_waypoints()
+		route_id = (route_signature(), current_waypoint)
+
+	heading = None
+	if info.has_key('avg_heading'): heading = info['avg_heading']
+
+	zoom = userpref['map_zoom']
+	if map_view != None and map_view.key != None:
+		zoom = map_view.key[0]
+
+	speed = info['speed_avg'].mean()
+	if speed == None: speed = 0.
+
+	prefetcher.update(wgs_ll[0], wgs_ll[1], heading, speed, zoom, route, route_id)
 #############################################################################
 
 # Lock, so python won't exit during non canvas graphical stuff
@@ -2313,7 +2355,16 @@ def draw_details():
 
 	yPos += (line_spacing*2)
 	canvas.text( (0, yPos), u'Satellites in view', 0x008000, font)
-	if satellites.has_key('in_view'):
+	if satellites.has_key('table'):
+		# Straight from the GSV satellite table, those without signal in brackets
+		table = satellites['table']
+		in_view = []
+		for prn in table.prns():
+			if table.snr[prn] > 0:	in_view.append("%02d" % prn)
+			else:					in_view.append("(%02d)" % prn)
+		canvas.text( (indent_large,yPos), unicode(table.count), font=font )
+		canvas.text( (indent_slight,yPos+line_spacing), unicode(' '.join(in_view)), font=font )
+	elif satellites.has_key('in_view'):
 		canvas.text( (indent_large,yPos), unicode( len(satellites['in_view']) ), font=font )
 		canvas.text( (indent_slight,yPos+line_spacing), unicode(' '.join(satellites['in_view'])), font=font )
 	else:
@@ -2341,6 +2392,19 @@ def draw_details():
 		logging = logging + u'  +GSM'
 	canvas.text( (indent_large,yPos), logging, font=font)
 
+	if hasattr(gps, 'parser'):
+		stats = gps.parser.stats
+		yPos += line_spacing
+		canvas.text( (0, yPos), u'NMEA', 0x008000, font)
+		canvas.text( (indent_large,yPos), u"%d ok %d bad %d frag %d exc" % (stats['checksum_ok'],
+			stats['checksum_failed'], stats['fragments'], stats['exceptions']), font=font)
+
+	timing = fix_timing_text()
+	if timing != None:
+		yPos += line_spacing
+		canvas.text( (0, yPos), u'Fix age', 0x008000, font)
+		canvas.text( (indent_large,yPos), unicode(timing), font=font)
+
 	if not disp_notices == '':
 		yPos += line_spacing
 		canvas.text( (0,yPos), unicode(disp_notices), 0x000080, font)
@@ -2597,113 +2661,304 @@ def draw_track():
 
 
 
-class MapImage:
-	def __init__(self, x, y, z, file):
-		self.x = x
-		self.y = y
-		self.z = z
-		self.file = file
-		self.img = None
-		self.loaded = False
+class MapViewport:
+	"""Composes the OSM tiles of the visible area into one image.
+	The composite covers the screen plus one tile on every side and is
+	memoized by (zoom, origin tile), so a pan which stays inside of it
+	only needs an offset blit instead of loading all tiles again.
+	Only tiles on the disk are used, so drawing never waits for the
+	network. When online, the missing ones are handed to the fetcher
+	(an OSM_Prefetcher) and blitted in once they are on the disk."""
+	def __init__(self, loader, width, height, fetcher = None):
+		self.loader = loader
+		self.fetcher = fetcher
+		self.width = width
+		self.height = height
+		self.tile_size = OSM_TILE_SIZE
+		self.cols = width / self.tile_size + 3
+		self.rows = height / self.tile_size + 3
+		self.key = None			# (zoom, x, y) of the upper left tile of the composite
+		self.composite = None
+		self.missing = []		# tiles which could not be loaded into the composite
+		self.missing_time = 0.
+		self.screen = Image.new((width, height))
+		self.origin = (0, 0)	# world pixel coordinates of the upper left screen corner
+
+	def load_tile(self, x, y):
+		"""Blits a single tile from the disk into the composite. Returns
+		False if the tile is not there."""
+		zoom, tx, ty = self.key
+		n = 2 ** zoom
+		if y < 0 or y >= n: return True # there is nothing north or south of the map
+		file = self.loader.get_tile(zoom, x % n, y, False)[0]
+		if file == None: return False
+		try:	img = Image.open(file)
+		except:	return False
+		self.composite.blit(img, target = ((x - tx) * self.tile_size, (y - ty) * self.tile_size))
+		return True
+
+	def fetch_missing(self, online):
+		"Asks the fetcher for the tiles which weren't on the disk"
+		if not online or self.fetcher == None: return
+		n = 2 ** self.key[0]
+		self.fetcher.request([(self.key[0], t[0] % n, t[1]) for t in self.missing])
+
+	def compose(self, zoom, tx, ty, online):
+		"Loads all tiles of the composite with (tx, ty) as the upper left tile"
+		if self.composite == None:
+			self.composite = Image.new((self.cols * self.tile_size, self.rows * self.tile_size))
+		self.composite.clear(RGB_WHITE)
+		self.key = (zoom, tx, ty)
+		self.missing = []
+		for x in range(tx, tx + self.cols):
+			for y in range(ty, ty + self.rows):
+				if not self.load_tile(x, y):
+					self.missing.append((x, y))
+		self.missing_time = time.time()
+		self.fetch_missing(online)
+
+	def covers(self, zoom, ox, oy):
+		"Checks if the screen with the upper left corner (ox, oy) lies inside the composite"
+		if self.key == None or self.key[0] != zoom: return False
+		left = self.key[1] * self.tile_size
+		top  = self.key[2] * self.tile_size
+		return ox >= left and oy >= top\
+			and ox + self.width  <= left + self.cols * self.tile_size\
+			and oy + self.height <= top  + self.rows * self.tile_size
+
+	def render(self, zoom, centre, online = True):
+		"""Returns an image of the screen size showing the map at the given
+		zoom level. centre are the world pixel coordinates of the screen centre."""
+		ox = int(centre[0]) - self.width / 2
+		oy = int(centre[1]) - self.height / 2
+		self.origin = (ox, oy)
+
+		if not self.covers(zoom, ox, oy):
+			self.compose(zoom, ox / self.tile_size - 1, oy / self.tile_size - 1, online)
+		elif len(self.missing) > 0 and time.time() - self.missing_time > 1.:
+			# blit the tiles which have arrived since, and ask again for
+			#  the others, in case the fetcher moved on to another screen
+			missing = self.missing
+			self.missing = []
+			for t in missing:
+				if not self.load_tile(t[0], t[1]):
+					self.missing.append(t)
+			self.missing_time = time.time()
+			self.fetch_missing(online)
+
+		sx = ox - self.key[1] * self.tile_size
+		sy = oy - self.key[2] * self.tile_size
+		self.screen.blit(self.composite, source = ((sx, sy), (sx + self.width, sy + self.height)))
+		return self.screen
+
+	def to_screen(self, xy, zoom):
+		"""Turns coordinates from OSM_deg2xy(lat, lon, 0) into screen coordinates"""
+		scale = self.tile_size * 2 ** zoom
+		return [int(xy[0] * scale) - self.origin[0], int(xy[1] * scale) - self.origin[1]]
+
+class RouteOverlay:
+	"""Cache of transparent tiles in the OSM z/x/y scheme, with the route
+	and the recorded track drawn on them. A tile is drawn when it becomes
+	visible the first time and is kept until the route changes, so a
+	redraw of the map only costs a few tile blits."""
+	def __init__(self, max_tiles = 24):
+		self.tile_size = OSM_TILE_SIZE
+		self.max_tiles = max_tiles	# tile images kept in memory
+		self.route = []		# route at zoom level 0, see OSM_deg2xy
+		self.track = []		# recorded track at zoom level 0
+		self.route_id = None
+		self.bbox = None	# [xmin, ymin, xmax, ymax] of the route
+		self.index = {}		# zoom -> {(x, y) : segments crossing that tile}
+		self.tiles = {}		# (zoom, x, y) -> (image, mask)
+		self.used = []		# keys of tiles, the least recently used first
+
+	def clear(self):
+		self.index = {}
+		self.tiles = {}
+		self.used = []
+
+	def set_route(self, waypoints, route_id):
+		"Replaces the route if route_id has changed"
+		if route_id == self.route_id: return
+		self.route_id = route_id
+		self.route = []
+		self.bbox = None
+		for w in waypoints:
+			try:	xy = OSM_deg2xy(float(w[1]),float(w[2]),0)
+			except:	continue
+			self.route.append(xy)
+			if self.bbox == None: self.bbox = [xy[0], xy[1], xy[0], xy[1]]
+			self.bbox[0] = min(self.bbox[0], xy[0])
+			self.bbox[1] = min(self.bbox[1], xy[1])
+			self.bbox[2] = max(self.bbox[2], xy[0])
+			self.bbox[3] = max(self.bbox[3], xy[1])
+		self.clear()
+
+	def load_track(self, filename):
+		"Loads the track from a track log in the simple format (see the log_simple setting)"
+		try:
+			f = open(filename, "r")
+			lines = f.readlines()
+			f.close()
+		except IOError:
+			return
+		for l in lines:
+			t = l.split()
+			try:	self.append_track(float(t[1]), float(t[2]))
+			except (IndexError, ValueError): continue
+
+	def append_track(self, lat, lon):
+		"Adds a point to the track, only the tiles it crosses are drawn again"
+		self.track.append(OSM_deg2xy(lat, lon, 0))
+		if len(self.track) < 2: return
+		seg = (self.track[-2], self.track[-1], 0x5B75A5, 1)
+		for zoom in self.index.keys():
+			for t in self.add_segment(zoom, seg):
+				key = (zoom, t[0], t[1])
+				if self.tiles.has_key(key):
+					del self.tiles[key]
+					self.used.remove(key)
+
+	def add_segment(self, zoom, seg):
+		"Adds the segment to the index of all tiles it crosses, returns these tiles"
+		index = self.index[zoom]
+		n = 2 ** zoom
+		margin = (seg[3] + 1.) / self.tile_size # the line width, in tiles
+		x0 = seg[0][0] * n
+		y0 = seg[0][1] * n
+		dx = seg[1][0] * n - x0
+		dy = seg[1][1] * n - y0
+		steps = int(max(abs(dx), abs(dy)) * 2.) + 1 # pieces of at most half a tile
+		tiles = {}
+		for k in range(steps):
+			ax = x0 + dx * k / steps
+			ay = y0 + dy * k / steps
+			bx = x0 + dx * (k + 1) / steps
+			by = y0 + dy * (k + 1) / steps
+			for x in range(int(math.floor(min(ax, bx) - margin)), int(math.floor(max(ax, bx) + margin)) + 1):
+				for y in range(int(math.floor(min(ay, by) - margin)), int(math.floor(max(ay, by) + margin)) + 1):
+					tiles[(x, y)] = True
+		for t in tiles.keys():
+			if not index.has_key(t): index[t] = []
+			index[t].append(seg)
+		return tiles.keys()
+
+	def segments(self, zoom, x, y):
+		"Returns the segments which cross the tile, the index is built once per zoom level"
+		if not self.index.has_key(zoom):
+			self.index[zoom] = {}
+			for i in range(len(self.route)-1):
+				self.add_segment(zoom, (self.route[i], self.route[i+1], 0x0000AA, 3))
+			for i in range(len(self.track)-1):
+				self.add_segment(zoom, (self.track[i], self.track[i+1], 0x5B75A5, 1))
+		return self.index[zoom].get((x, y))
+
+	def get_tile(self, zoom, x, y):
+		"Returns (image, mask) of the tile or None if nothing is on it"
+		key = (zoom, x, y)
+		if self.tiles.has_key(key):
+			self.used.remove(key)
+			self.used.append(key)
+			return self.tiles[key]
+
+		segs = self.segments(zoom, x, y)
+		if not segs: return None
+
+		ts = self.tile_size
+		img = Image.new((ts, ts))
+		mask = Image.new((ts, ts), '1')
+		img.clear(RGB_BLACK)
+		mask.clear(RGB_BLACK)
+		scale = ts * 2 ** zoom
+		ox = x * ts
+		oy = y * ts
+		for seg in segs:
+			line = [seg[0][0] * scale - ox, seg[0][1] * scale - oy, seg[1][0] * scale - ox, seg[1][1] * scale - oy]
+			img.line(line, outline=seg[2], width=seg[3])
+			mask.line(line, outline=RGB_WHITE, width=seg[3])
+
+		self.tiles[key] = (img, mask)
+		self.used.append(key)
+		if len(self.used) > self.max_tiles:
+			del self.tiles[self.used.pop(0)]
+		return self.tiles[key]
+
+	def draw(self, image, zoom, origin, width, height):
+		"Blits the tiles of the visible area onto image, origin is its upper left corner in world pixels"
+		ts = self.tile_size
+		for x in range(origin[0] / ts, (origin[0] + width) / ts + 1):
+			for y in range(origin[1] / ts, (origin[1] + height) / ts + 1):
+				tile = self.get_tile(zoom, x, y)
+				if tile: image.blit(tile[0], target = (x * ts - origin[0], y * ts - origin[1]), mask = tile[1])
+
+def route_signature():
+	"Changes whenever the route is changed or replaced"
+	return (id(waypoints), route_version)
+
+map_view = None 		# MapViewport, created with the first map drawn
+route_overlay = None	# RouteOverlay, created with the first map drawn
 
 def draw_map():
 	global Map
+	global map_view
+	global route_overlay
 	global waypoints
 	global location
-#	global map_img
 
-	zoomvalue = 11
-	if not Map:
+	if not has_OSM:
 		appuifw.note(u'Sorry, but OSM.py not loaded.' ,"error")
 		return
 
-	mapinfo = []
-	fname = None
-	#get the maps
-	#for w in waypoints:
-		#res = Map.get_map(float(w[1]),float(w[2]),zoomvalue, online = False)
-		#if not res in mapinfo: mapinfo.append(MapImage(res[1], res[2], zoomvalue, res[0]))
-	mymap = Image.new((screen_width,screen_height))
-
-#	if fname:
-#		print fname
-#		map_img = Image.open(fname)
-#		canvas.blit(map_img,target=(20,20))
-
-#	mymap.blit(map_img,target=(0,0))
-
-	#def turn_llh_into_xyz(lat_dec,long_dec,height,system)
-
-	coords = []
-	for w in waypoints:
-		#try:
-		res = OSM_deg2xy(float(w[1]),float(w[2]),zoomvalue)
-		coords.append(res)
-		#except:
-			#continue
+	if map_view == None:
+		map_view = MapViewport(Map, screen_width, screen_height, prefetcher)
+	if route_overlay == None:
+		route_overlay = RouteOverlay()
+		if userpref.has_key('logfile'):
+			# The points logged last may still be in the buffer of the log
+			if log_track != None and log_track.fullpath == userpref['logfile']: log_track.flush()
+			route_overlay.load_track(userpref['logfile'])
+	route_overlay.set_route(waypoints, route_signature())
 
 	# append current position
 	own_position = None
 	if location['valid'] == 1:
 		wgs_ll = get_latlong_floats()
-		try:	own_position = OSM_deg2xy(wgs_ll[0],wgs_ll[1],zoomvalue) # turn_llh_into_xyz(wgs_ll[0],wgs_ll[1],0. ,'wgs84')
+		try:	own_position = OSM_deg2xy(wgs_ll[0],wgs_ll[1],0)
 		except: own_position = None
 
-	if len(coords) > 0:
-		if own_position:
-			xmin = own_position[0]
-			xmax = own_position[0]
-			ymin = own_position[1]
-			ymax = own_position[1]
-		else:
-			xmin = coords[0][0]
-			xmax = coords[0][0]
-			ymin = coords[0][1]
-			ymax = coords[0][1]
-
-		for i in coords:
-			if i[0] < xmin : xmin = i[0]
-			if i[0] > xmax : xmax = i[0]
-			if i[1] < ymin : ymin = i[1]
-			if i[1] > ymax : ymax = i[1]
-
-		#print "----------------------"
-		#print xmin, xmax , ymin, ymax
-
-		xfactor = (xmax - xmin) / float(screen_width)
-		yfactor = (ymax - ymin) / float(screen_height)
-		factor = max(xfactor, yfactor) # select the largest scaling factor
-
-		#print xfactor, yfactor
-		if factor:
-			for i in range(len(coords)):
-
-				coords[i][0] -= (xmin)
-				coords[i][1] -= (ymin)
-
-				coords[i][0] /= factor
-				coords[i][1] /= factor
-
-				coords[i][0] = int(coords[i][0])
-				coords[i][1] = int(coords[i][1])
-
-			if own_position:
-				own_position[0] -= (xmin)
-				own_position[1] -= (ymin)
-
-				own_position[0] /= factor
-				own_position[1] /= factor
-
-				own_position[0] = int(own_position[0])
-				own_position[1] = int(own_position[1])
-
-				canvas.point([own_position[0], own_position[1]], outline=0xAA0000, width=10)
+	if route_overlay.bbox == None and own_position == None:
+		mymap = Image.new((screen_width,screen_height))
+		mymap.text( ( small_line_spacing, line_spacing), u'No track or position available.' , 0x008000, "normal")
+		canvas.blit(mymap)
+		return
 
-	# plot the track
-	for i in range(len(coords)-1):
-		mymap.line([coords[i],coords[i+1]], outline=0x0000AA,width=3)
+	if route_overlay.bbox != None:
+		xmin, ymin, xmax, ymax = route_overlay.bbox
+	else:
+		xmin = xmax = own_position[0]
+		ymin = ymax = own_position[1]
+	if own_position:
+		xmin = min(xmin, own_position[0])
+		xmax = max(xmax, own_position[0])
+		ymin = min(ymin, own_position[1])
+		ymax = max(ymax, own_position[1])
+
+	# select the largest zoom level which shows everything
+	zoomvalue = userpref['map_zoom']
+	while zoomvalue > 0 and ( (xmax - xmin) * OSM_TILE_SIZE * 2 ** zoomvalue > screen_width\
+			or (ymax - ymin) * OSM_TILE_SIZE * 2 ** zoomvalue > screen_height ):
+		zoomvalue -= 1
+
+	scale = OSM_TILE_SIZE * 2 ** zoomvalue
+	centre = ( (xmin + xmax) / 2. * scale, (ymin + ymax) / 2. * scale )
+	mymap = map_view.render(zoomvalue, centre, userpref['map_online'])
+
+	# plot the route and the track
+	route_overlay.draw(mymap, zoomvalue, map_view.origin, screen_width, screen_height)
+
+	if own_position:
+		mymap.point(map_view.to_screen(own_position, zoomvalue), outline=0xAA0000, width=10)
 
-#	canvas.clear()
 	canvas.blit(mymap)
 
 
@@ -2727,11 +2982,7 @@ def draw_os_data():
 	if location.has_key('alt'):
 		canvas.text( (indent_large,yPos), unicode(location['alt']), font=font )
 
-		# Remove ' M'
-		wgs_height = location['alt']
-		wgs_height = wgs_height[0:-1]
-		if wgs_height[-1:] == '':
-			wgs_height = wgs_height[0:-1]
+		if fix.alt != None: wgs_height = fix.alt
 	if location['valid'] == 0:
 		canvas.text( (indent_slight,yPos+line_spacing), u'(invalid location)', font=font )
 	else:
@@ -3066,6 +3317,7 @@ def touch_up_destination_cb(pos=(0, 0)):
 			i=appuifw.selection_list(sel, search_field=1)
 			if i > -1:
 				waypoints.append(list[i])
+				route_changed()
 				current_waypoint = len(waypoints) - 1 # set the waypoint
 			del list
 			current_state = 'main'
@@ -3092,6 +3344,7 @@ def touch_up_destination_cb(pos=(0, 0)):
 						if li.startswith('#') or len(li) == 0: continue
 						wp = li.split()
 						waypoints.append(wp)
+					route_changed()
 					appuifw.note(u"# waypoints: %d" % len(waypoints), "info");
 					if len(waypoints) > 0:	current_waypoint = 0
 					else: current_waypoint = None
@@ -3117,6 +3370,7 @@ def touch_up_destination_cb(pos=(0, 0)):
 			#appuifw.note(u"Not implemented yet.", "info");
 		elif touch['down'] == 5:
 			del waypoints[:]
+			route_changed()
 			current_waypoint = None
 			current_state = 'track'
 
@@ -3323,6 +3577,22 @@ def pick_config():
 	#appuifw.note(u'Configuration menu not yet supported!\nEdit script header to configure',"info")
 	settings_form.show(userpref)
 
+def pick_nmea_counters():
+	"""Writes the counters of the NMEA parser, and the fix timing, to a file"""
+	filename = userpref['base_dir'] + 'nmea_counters.txt'
+	f = open(filename, 'a')
+	f.write("%s, %s\n" % (str(gps), time.strftime('%H:%M:%S, %Y-%m-%d', time.localtime(time.time()))))
+	if hasattr(gps, 'parser'):
+		for line in gps.parser.report():
+			f.write("  %s\n" % line)
+	if hasattr(gps, 'reader'):
+		f.write("  gpsd reports %(reports)d, broken %(broken)d\n" % gps.reader.stats)
+	timing = fix_timing_text()
+	if timing != None:
+		f.write("  fix age (median/95%%) %s\n" % timing)
+	f.close()
+	appuifw.note(u"NMEA counters written to %s" % filename, "info")
+
 def pick_upload():
 	"""TODO: Implement me!"""
 	appuifw.note(u'Please use upload_track.py\nSee http://gagravarr.org/code/', "info")
@@ -3364,6 +3634,15 @@ def do_add_as_waypoint():
 
 #############################################################################
 
+def new_nmea_parser():
+	"""A NmeaParser for the sentences and talkers the settings ask for"""
+	parser = NmeaParser(log = debug_log)
+	if userpref['nmea_sentences']:
+		parser.subscribe([s.strip().upper() for s in userpref['nmea_sentences'].split(',')])
+	if userpref['multi_gnss']:
+		parser.accept_talkers(None)
+	return parser
+
 class GPS(object):
 	connected = False
 	def connect(self):
@@ -3384,6 +3663,10 @@ class BT(GPS):
 		self.gps_addr = None
 		self.target = None
 		self.sock = None
+		self.chunk_size = 1024	# bytes read at once, high rate receivers send much more
+		if userpref['multi_gnss']: self.chunk_size = 4096
+		self.parser = new_nmea_parser()
+		self.assembler = EpochAssembler(userpref['epoch_sentence'] or None)
 	def __repr__(self):
 		return self.gps_addr
 	def identify_gps(self):
@@ -3402,6 +3685,7 @@ class BT(GPS):
 		self.sock.close()
 		self.connected = False
 	def connect(self):
+		global disp_notices
 		try:
 			# Connect to the bluetooth GPS using the serial service
 			self.sock = socket.socket(socket.AF_BT, socket.SOCK_STREAM)
@@ -3418,9 +3702,8 @@ class BT(GPS):
 			#e32.ao_sleep(5)
 			return False
 	def process(self):
-		global log_track
 		try:
-			rawdata = readline(self.sock)
+			chunk = self.sock.recv(self.chunk_size)
 		except socket.error, inst:
 			# GPS has disconnected, bummer
 			self.connected = False
@@ -3430,81 +3713,222 @@ class BT(GPS):
 			appuifw.note(u"Disconnected from the GPS. Retrying...")
 			return 0
 
-		# Try to process the data from the GPS
-		# If it's gibberish, skip that line and move on
-		# (Not all bluetooth GPSs are created equal....)
+		# Collect the sentences into epochs, one per fix
+		epochs = []
+		for update in self.parser.feed(chunk):
+			epochs.extend(self.assembler.add(update))
+		epochs.extend(self.assembler.expire())
+
+		for epoch in epochs:
+			apply_nmea_epoch(epoch, self.parser)
+
+		# Number of new fixes, each needs a re-draw of the screen
+		return len(epochs)
+
+class ReplayGPS(GPS):
+	"Replays a recorded NMEA log, like the ones of save_gga_log or debug_log"
+	def __init__(self, filename, speed = 1., start = None):
+		self.filename = filename
+		self.speed = speed	# 1 = real time, 10 = ten times faster, 0 = as fast as possible
+		self.start = start	# seconds since midnight UTC to seek to, None = from the beginning
+		self.file = None
+		self.parser = new_nmea_parser()
+		self.assembler = EpochAssembler()
+		self.day = 0		# seconds added for every midnight passed in the log
+		self.last_time = None
+		self.base = None	# (log time, real time) of the first epoch replayed
+		self.log_time = None	# log time of the last epoch, drives the fake clock
+	def __repr__(self):
+		return "Replay " + os.path.basename(self.filename)
+	def connect(self):
+		try:
+			self.file = open(self.filename, 'r')
+		except IOError, inst:
+			appuifw.note(u"Can't open the replay %s" % self.filename, 'error')
+			e32.ao_sleep(5)
+			return False
+		self.connected = True
+		set_clock(self.clock)
+		return True
+	def clock(self):
+		"""The fake clock: the real time at the start of the replay, plus the log time passed"""
+		if self.base == None or self.log_time == None: return time.time()
+		return self.base[1] + (self.log_time - self.base[0])
+	def epoch_time(self, epoch):
+		"""Log time of an epoch in seconds, counting on over midnight"""
+		t = None
+		for update in epoch:
+			if update.has_key('fix') and update['fix'].get('time') != None:
+				t = update['fix']['time']
+		if t == None: return self.last_time
+		if self.last_time != None and t + self.day < self.last_time - 43200:
+			self.day += 86400
+		self.last_time = t + self.day
+		return self.last_time
+	def read_epochs(self):
+		"""Reads until at least one epoch is complete, returns the epochs"""
+		epochs = []
+		while not epochs:
+			line = self.file.readline()
+			if not line:
+				self.file.close()
+				self.file = None
+				epochs.extend(self.assembler.expire(now() + self.assembler.timeout))
+				debug_log("Replay of %s done" % self.filename)
+				break
+			for update in self.parser.feed(line):
+				epochs.extend(self.assembler.add(update))
+		return epochs
+	def replay(self, epoch):
+		"""Applies the updates of an epoch when it's due, returns False if it was skipped by a seek"""
+		t = self.epoch_time(epoch)
+		if self.start != None:
+			if t == None: return False
+			# start is the time of day closest to where we are in the log
+			start = t - t % 86400 + self.start
+			if start < t - 43200: start += 86400
+			if t < start: return False
+			self.start = None
+		if t != None:
+			if self.base == None: self.base = (t, time.time())
+			self.log_time = t
+			# Wait until the epoch is due
+			if self.speed > 0:
+				delay = self.base[1] + (t - self.base[0]) / self.speed - time.time()
+				if delay > 0: e32.ao_sleep(delay)
+
+		# It only arrives now, the wait for it isn't our latency
+		if epoch: epoch[0]['arrived'] = time.time()
+		apply_nmea_epoch(epoch, self.parser)
+		return True
+	def seek(self, start):
+		"""Skip ahead to the first epoch at or after start (seconds since midnight UTC)"""
+		self.start = start
+		self.base = None
+	def process(self):
+		if self.file == None:
+			# All replayed
+			e32.ao_sleep(0.5)
+			return 0
+
+		# Read until an epoch is replayed (after the start, if seeking)
+		fixes = 0
+		while fixes == 0 and self.file != None:
+			for epoch in self.read_epochs():
+				if self.replay(epoch): fixes += 1
+		return fixes
+	def shutdown(self):
+		if self.file != None: self.file.close()
+		set_clock()
+
+class SyntheticGPS(GPS):
+	"Generates NMEA for fixes along the route, or on a random walk, for load tests"
+	def __init__(self, route, rate = 1.):
+		self.rate = min(100., max(1., rate))
+		self.generator = NmeaGenerator(route = route, rate = self.rate,
+			speed = userpref['synthetic_speed'], noise = userpref['synthetic_noise'],
+			dropout = userpref['synthetic_dropout'], corrupt = userpref['synthetic_corrupt'],
+			satellites = userpref['synthetic_satellites'])
+		self.parser = new_nmea_parser()
+		self.assembler = EpochAssembler('VTG')
+		self.due = None	# time the next epoch is generated
+	def __repr__(self):
+		return "Synthetic %g Hz" % self.rate
+	def connect(self):
+		self.connected = True
+		self.due = time.time()
+		return True
+	def process(self):
+		# Keep to the rate, without falling ever further behind
+		delay = self.due - time.time()
+		if delay > 0: e32.ao_sleep(delay)
+		self.due = max(self.due + 1. / self.rate, time.time() - 1.)
+
+		epochs = []
+		for update in self.parser.feed(self.generator.epoch()):
+			epochs.extend(self.assembler.add(update))
+		epochs.extend(self.assembler.expire())
+		for epoch in epochs:
+			apply_nmea_epoch(epoch, self.parser)
+		return len(epochs)
+
+class StreamGPS(GPS):
+	"NMEA from a serial port, pty or TCP connection of nmea_stream, read without blocking"
+	def __init__(self, stream):
+		self.stream = stream
+		self.parser = new_nmea_parser()
+		self.assembler = EpochAssembler(userpref['epoch_sentence'] or None)
+	def __repr__(self):
+		return str(self.stream)
+	def connect(self):
+		global disp_notices
+		# TCP connects take several calls, until then we're retried like BT
+		if self.stream.connect():
+			self.connected = True
+			debug_log("CONNECTED to GPS: %s at %s" % (str(self.stream), time.strftime('%H:%M:%S', time.localtime(time.time()))))
+			disp_notices = "Connected to GPS."
+			return True
+		self.connected = False
+		disp_notices = "Connect to GPS failed.  Retrying..."
+		return False
+	def process(self):
+		# Wait a bit for data, but never block on the source
+		try:
+			chunk = self.stream.wait(0.4)
+		except IOError, inst:
+			self.connected = False
+			debug_log("DISCONNECTED from GPS: %s at %s" % (str(inst), time.strftime('%H:%M:%S, %Y-%m-%d', time.localtime(time.time()))))
+			appuifw.note(u"Disconnected from the GPS. Retrying...")
+			return 0
+
+		epochs = []
+		if chunk:
+			for update in self.parser.feed(chunk):
+				epochs.extend(self.assembler.add(update))
+		epochs.extend(self.assembler.expire())
+		for epoch in epochs:
+			apply_nmea_epoch(epoch, self.parser)
+		return len(epochs)
+	def shutdown(self):
+		self.stream.close()
+		self.connected = False
+
+class GpsdGPS(StreamGPS):
+	"""The JSON fixes of gpsd, without going through NMEA. The parser
+	isn't fed, it only counts the reports which couldn't be used."""
+	def __init__(self, host, port = 2947):
+		StreamGPS.__init__(self, GpsdStream(host, port))
+		self.reader = GpsdReader()
+	def __repr__(self):
+		return "gpsd " + str(self.stream)
+	def process(self):
 		try:
-			data = rawdata.strip()
-
-			# Discard fragmentary sentences -  start with the last '$'
-			startsign = rawdata.rfind('$')
-			data = data[startsign:]
-
-			# Ensure it starts with $GP
-			if not data[0:3] == '$GP':
-				return 0
-
-			# If it has a checksum, ensure that's correct
-			# (Checksum follows *, and is XOR of everything from
-			#  the $ to the *, exclusive)
-			if data[-3] == '*':
-				exp_checksum = generate_checksum(data[1:-3])
-				if not exp_checksum == data[-2:]:
-					disp_notices = "Invalid checksum %s, expecting %s" % (data[-2:], exp_checksum)
-					return 0
-
-				# Strip the checksum
-				data = data[:-3]
-
-			# Grab the parts of the sentence
-			talker = data[1:3]
-			sentence_id = data[3:6]
-			sentence_data = data[7:]
-
-			# Do we need to re-draw the screen?
-			redraw = 0
-
-			# The NMEA location sentences we're interested in are:
-			#  GGA - Global Positioning System Fix Data
-			#  GLL - Geographic Position
-			#  RMC - GPS Transit Data
-			if sentence_id == 'GGA':
-				do_gga_location(sentence_data)
-				redraw = 1
-
-				# Log GGA packets periodically
-				save_gga_log(rawdata)
-			if sentence_id == 'GLL':
-				do_gll_location(sentence_data)
-				redraw = 1
-			if sentence_id == 'RMC':
-				do_rmc_location(sentence_data)
-				redraw = 1
-
-			# The NMEA satellite sentences we're interested in are:
-			#  GSV - Satellites in view
-			#  GSA - Satellites used for positioning
-			if sentence_id == 'GSV':
-				do_gsv_satellite_view(sentence_data)
-				redraw = 1
-			if sentence_id == 'GSA':
-				do_gsa_satellites_used(sentence_data)
-				redraw = 1
-
-			# The NMEA motion sentences we're interested in are:
-			#  VTG - Track made good
-			# (RMC - GPS Transit - only in knots)
-			if sentence_id == 'VTG':
-				do_vtg_motion(sentence_data)
-				redraw = 1
+			chunk = self.stream.wait(0.4)
+		except IOError, inst:
+			self.connected = False
+			debug_log("DISCONNECTED from GPS: %s at %s" % (str(inst), time.strftime('%H:%M:%S, %Y-%m-%d', time.localtime(time.time()))))
+			appuifw.note(u"Disconnected from the GPS. Retrying...")
+			return 0
 
-		# Catch exceptions cased by the GPS sending us crud
-		except (RuntimeError, TypeError, NameError, ValueError, ArithmeticError, LookupError, AttributeError), inst:
-			print "Exception: %s" % str(inst)
+		# Every TPV report is a fix
+		fixes = 0
+		try:
+			for data in self.reader.feed(chunk):
+				process_positioning_update(data)
+				publish_fix()
+				fixes += 1
+		# Catch exceptions caused by gpsd sending us crud
+		except NMEA_ERRORS, inst:
+			self.parser.count_exception(inst)
 			debug_log("EXCEPTION: %s" % str(inst))
-			return 0
+		return fixes
 
-		return redraw
+def parse_replay_start(text):
+	"""Seconds since midnight of a hh:mm:ss time, None if blank"""
+	if not text: return None
+	parts = [int(p) for p in text.split(':')]
+	while len(parts) < 3: parts.append(0)
+	return parts[0] * 3600 + parts[1] * 60 + parts[2]
 
 class PythonPositioning(GPS):
 	"S60 Python Positioning module powered GPS Functionality"
@@ -3512,6 +3936,7 @@ class PythonPositioning(GPS):
 		self.id = None
 		self.default_id = positioning.default_module()
 		self.type = "Unknown"
+		self.updates = 0 # callbacks since the last process
 	def __repr__(self):
 		return self.type
 	def identify_gps(self):
@@ -3537,6 +3962,7 @@ class PythonPositioning(GPS):
 		if not self.id:
 			self.id = self.default_id
 	def connect(self):
+		global disp_notices
 		# Connect, and install the callback
 		try:
 			print "Activating module with id '%d'" % self.id
@@ -3548,7 +3974,7 @@ class PythonPositioning(GPS):
 			positioning.position(
 								course=1,
 								satellites=1,
-								callback=process_positioning_update,
+								callback=self.callback,
 								interval=1000000,
 								partial=1
 			)
@@ -3559,14 +3985,33 @@ class PythonPositioning(GPS):
 			disp_notices = "Connect to GPS failed with %s, retrying" % reason
 			self.connected = False
 			return False
+	def callback(self, data):
+		process_positioning_update(data)
+		publish_fix()
+		self.updates += 1
 	def process(self):
-		# return value 1: we need a redraw, 0: we need no redraw
+		# Every callback is a new fix, which needs a redraw
 		e32.ao_sleep(0.4)
-		return 1
+		updates = self.updates
+		self.updates = 0
+		return updates
 	def shutdown(self):
 		positioning.stop_position()
 
-if has_positioning and not pref['force_bluetooth']:
+if userpref['synthetic_gps'] and has_generator:
+	route = []
+	for waypoint in waypoints:
+		try:	route.append((float(waypoint[1]), float(waypoint[2])))
+		except (ValueError, TypeError): pass
+	gps = SyntheticGPS(route, userpref['synthetic_rate'])
+elif userpref['replay_file']:
+	gps = ReplayGPS(userpref['replay_file'], userpref['replay_speed'], parse_replay_start(userpref['replay_start']))
+elif userpref['nmea_source'] and has_stream:
+	gps = StreamGPS(open_stream(userpref['nmea_source']))
+elif userpref['gpsd_source'] and has_gpsd:
+	host, port = (userpref['gpsd_source'].split(':') + ['2947'])[:2]
+	gps = GpsdGPS(host, int(port))
+elif has_positioning and not pref['force_bluetooth']:
 	gps = PythonPositioning()
 	#appuifw.note(u'"Iternal GPS positioning will be used."',"info")
 else:
@@ -3574,6 +4019,12 @@ else:
 	#appuifw.note(u'"Looking for Bluetooth devices"',"info")
 gps.identify_gps()
 
+if userpref['fanout_port'] > 0 and has_fanout:
+	try:
+		fanout = FanoutServer((userpref['fanout_host'] or '127.0.0.1', userpref['fanout_port']))
+	except socket.error, inst:
+		appuifw.note(u"Can't pass the GPS on at port %d" % userpref['fanout_port'], 'error')
+
 # Not yet connected
 gps.connected = False
 
@@ -3655,6 +4106,7 @@ appuifw.app.menu=[
 	(u'Direction Of',pick_direction_of),
 	(u'Take Photo',pick_take_photo),
 	(u'Upload',pick_upload),
+	(u'NMEA counters',pick_nmea_counters),
 	(u'Configuration',pick_config),
 	]
 
@@ -3667,6 +4119,10 @@ lock = e32.Ao_lock()
 # start the timer
 info_thread = thread.start_new_thread(speech_timer,())
 
+# download the map tiles ahead of us
+if has_OSM and userpref['map_online']:
+	prefetcher.start()
+
 if not audio_info_on: #userpref['audio_info_on'] :
 	appuifw.note(u"audio info is OFF", "info")
 
@@ -3688,6 +4144,8 @@ while going > 0:
 			e32.ao_sleep(0.2)
 			continue
 
+	redraw = 0
+
 	# Take a preview photo, if they asked for one
 	# (Need to do it in this thread, otherwise it screws up the display)
 	if taking_photo == 1:
@@ -3700,6 +4158,7 @@ while going > 0:
 			# In case they requested a photo take while doing the preview
 			taking_photo = 0
 		photo_displays = 0
+		redraw = 1
 	# Take a real photo, and geo-tag it
 	# (Need to do it in this thread, otherwise it screws up the display)
 	if taking_photo == 2:
@@ -3723,15 +4182,24 @@ while going > 0:
 		appuifw.note(u"Taken photo", 'info')
 		taking_photo = 0
 
-	# If we are connected to the GPS, read a line from it
+	# If we are connected to the GPS, read from it
 	if gps.connected:
-		redraw = gps.process()
-
-		redraw = compute_positional_data()
+		# Navigation and drawing run once per fix, not per sentence,
+		#  and not for more than max_fix_rate fixes a second
+		fixes = gps.process()
+		computed = 0
+		if fixes > 0 and fixes_due(fixes):
+			if compute_positional_data() == 1: redraw = 1
+			fix.computed = time.time()
+			computed = 1
+
+		# Pass the GPS on, a slow client only loses its oldest sentences
+		if fanout != None: fanout.service()
 
 		# Update the state display if required
 		if redraw == 1:
 			draw_state()
+			if computed == 1: record_fix_timing()
 		#e32.ao_sleep(1) # sleep 1s for redraw
 
 	else:
@@ -3743,6 +4211,8 @@ else:
 	userpref['logfile'] = log_track.fullpath
 	write_settings(userpref)
 	gps.shutdown()
+	if fanout != None: fanout.close()
+	if has_OSM: prefetcher.stop()
 	close_debug_log()
 	close_stumblestore_gsm_log()
 
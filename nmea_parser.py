@@ -0,0 +1,997 @@
+# NMEA parsing helpers for nmea_info.py and friends
+#
+# Turns a stream of NMEA 0183 data into fix updates, without any UI
+#  or global state, so the same parser runs on the phone, on a desktop
+#  or in benchmarks:
+#
+#  parser = NmeaParser()
+#  for update in parser.feed(data):
+#      ...
+#
+# Every update is a dictionary with the sentence ID, the talker, the raw
+#  sentence and one or more of the keys 'location', 'satellites' and
+#  'motion', holding the values to store for that part of the fix, and
+#  'fix', holding the numeric values for a Fix. The 'location' values go
+#  into a LocationState, which formats its display strings when needed.
+#  The parts of a multi-part sentence but the last have 'more' set.
+#
+# For big captures parse_file() works on a bytearray with memoryview
+#  (python 2.7), and only copies the sentences a handler reads:
+#
+#  for update in parser.parse_file(open('capture.nmea', 'rb')):
+#      ...
+#
+# GPL
+
+import sys, time
+from array import array
+from binascii import hexlify
+
+# Exceptions raised by handlers when a GPS sends us crud
+NMEA_ERRORS = (RuntimeError, TypeError, NameError, ValueError, ArithmeticError, LookupError, AttributeError)
+
+# The clock for fix times and timeouts. A replayed log sets its own, so
+#  a recorded ride runs through the application faster than real time.
+clock = time.time
+
+def set_clock(function = None):
+	"""Use function instead of time.time as the clock, None to go back"""
+	global clock
+	clock = function or time.time
+
+def now():
+	return clock()
+
+# Wall clock timer for the parse times, picked like timeit.default_timer:
+#  time.clock is the finer wall clock on Windows, elsewhere it's CPU time
+if sys.platform == 'win32':	timer = time.clock
+else:						timer = time.time
+
+#############################################################################
+
+# The values of the hex digits of a checksum, by character and by byte
+HEX_DIGITS = dict(map(lambda c: (c, int(c, 16)), '0123456789ABCDEFabcdef'))
+HEX_DIGITS.update(map(lambda c: (ord(c), int(c, 16)), '0123456789ABCDEFabcdef'))
+
+# The checksum is all the data XOR'd. Rather than XOR one character at a
+#  time, the data is read as one big number (at most 128 bytes, a sentence
+#  is never longer than 82) whose halves are XOR'd onto each other until
+#  a single byte is left.
+def nmea_checksum(data):
+	"""The NMEA checksum of data (a string, bytearray or memoryview) as
+	an integer"""
+	n = len(data)
+	if n == 0:
+		return 0
+	if n > 128:
+		return nmea_checksum(data[:128]) ^ nmea_checksum(data[128:])
+	x = long(hexlify(data), 16)
+	x ^= x >> 512
+	x ^= x >> 256
+	x ^= x >> 128
+	x ^= x >> 64
+	x ^= x >> 32
+	x ^= x >> 16
+	x ^= x >> 8
+	return int(x & 0xFF)
+
+def checksum_ok(data, digits):
+	"""True if digits, the two hex digits after the '*', are the checksum
+	of data"""
+	try:
+		return nmea_checksum(data) == HEX_DIGITS[digits[0]] << 4 | HEX_DIGITS[digits[1]]
+	except (KeyError, IndexError):
+		return False
+
+# Generate the checksum for some data
+# (Checksum is all the data XOR'd, then turned into hex)
+def generate_checksum(data):
+	"""Generate the NMEA checksum for the supplied data"""
+	return "%02X" % nmea_checksum(data)
+
+# Format a NMEA timestamp into something friendly
+def format_time(time):
+	"""Generate a friendly form of an NMEA timestamp"""
+	hh = time[0:2]
+	mm = time[2:4]
+	ss = time[4:]
+	return "%s:%s:%s UTC" % (hh,mm,ss)
+
+# NMEA data is HHMM.nnnn where nnnn is decimal part of second
+def format_latlong(data):
+	"""Turn HHMM.nnnn into HH:MM.SS"""
+
+	# Check to see if it's HMM.nnnn or HHMM.nnnn or HHHMM.nnnn
+	if data[5:6] == '.':
+		# It's HHHMM.nnnn
+		hh_mm = data[0:3] + ":" + data[3:5]
+		dddd = data[6:]
+	elif data[3:4] == '.':
+		# It's HMM.nnnn
+		hh_mm = data[0:1] + ":" + data[1:3]
+		dddd = data[4:]
+	else:
+		# Assume HHMM.nnnn
+		hh_mm = data[0:2] + ":" + data[2:4]
+		dddd = data[5:]
+
+	# Turn from decimal into seconds, and strip off last 2 digits
+	sec = int( float(dddd) / 100.0 * 60.0 / 100.0 )
+	return hh_mm + ":" + str(sec)
+
+def format_latlong_dec(data):
+	"""Turn HHMM.nnnn into HH.ddddd"""
+
+	# Check to see if it's HMM.nnnn or HHMM.nnnn or HHHMM.nnnn
+	if data[5:6] == '.':
+		hours = data[0:3]
+		mins = float(data[3:])
+	elif data[3:4] == '.':
+		hours = data[0:1]
+		mins = float(data[1:])
+	else:
+		hours = data[0:2]
+		mins = float(data[2:])
+
+	dec = mins / 60.0 * 100.0
+	# Cap at 6 digits - currently nn.nnnnnnnn
+	dec = dec * 10000.0
+	str_dec = "%06d" % dec
+	return hours + "." + str_dec
+
+# The numbers for a Fix, straight from the NMEA fields
+def nmea_degrees(value, hemisphere):
+	"""Turn NMEA dddmm.mmmm and its hemisphere into degrees, negative
+	for south and west"""
+	if not value: return None
+	value = float(value)
+	degrees = int(value / 100)
+	degrees = degrees + (value - degrees * 100) / 60.0
+	if hemisphere == 'S' or hemisphere == 'W':
+		return -degrees
+	return degrees
+
+def nmea_seconds(value):
+	"""Turn a NMEA hhmmss.ss timestamp into seconds since midnight UTC"""
+	if len(value) < 6: return None
+	return int(value[0:2]) * 3600 + int(value[2:4]) * 60 + float(value[4:])
+
+def nmea_day(date):
+	"""Turn a NMEA ddmmyy date into days since 1970, None if it's empty"""
+	if len(date) < 6: return None
+	day = int(date[0:2])
+	month = int(date[2:4])
+	year = int(date[4:6])
+	if year < 80:	year += 2000
+	else:			year += 1900
+	# Count from March, so the leap day is the last day of the year
+	if month <= 2:
+		year -= 1
+		month += 12
+	return 365 * year + year / 4 - year / 100 + year / 400 + (153 * (month - 3) + 2) / 5 + day - 719469
+
+def gps_time(seconds, state):
+	"""Seconds since 1970 of a time of day on the day of the last RMC
+	date, None before there was one"""
+	base = state.get('day_base')
+	if base == None or seconds == None: return None
+	t = base + seconds
+	# A GGA just after midnight can come before the RMC with the new date
+	last = state.get('gps_time')
+	if last != None and t < last - 43200: t += 86400
+	state['gps_time'] = t
+	return t
+
+def nmea_float(value):
+	"""A float for a numeric field, None if it's empty"""
+	if not value: return None
+	return float(value)
+
+#############################################################################
+
+class Fix(object):
+	"""Our position and motion as numbers: lat and lon in degrees (south
+	and west negative), alt in meters, time in seconds since midnight
+	UTC, gps_time in seconds since 1970 UTC, speed in meters per second
+	and heading in degrees. arrived, computed and drawn are the times
+	(time.time) the fix was read from the GPS, navigated and drawn.
+	Unknown values are None."""
+	__slots__ = ('lat', 'lon', 'alt', 'time', 'gps_time', 'speed', 'heading', 'pdop', 'hdop', 'vdop', 'valid',
+		'arrived', 'computed', 'drawn')
+
+	def __init__(self):
+		self.clear()
+
+	def clear(self):
+		for name in self.__slots__:
+			setattr(self, name, None)
+		self.valid = 1 # Default to valid, in case no GGA/GLL sentences
+
+	def update(self, values):
+		"""Sets the values of the dictionary values"""
+		for name, value in values.items():
+			setattr(self, name, value)
+
+	def latlong(self):
+		"""(lat, lon) of a valid fix, otherwise None"""
+		if self.valid == 0 or self.lat == None or self.lon == None:
+			return None
+		return (self.lat, self.lon)
+
+# The display strings of the location, made from its NMEA fields
+def format_nmea_latlong(field):
+	return "%s%s" % (format_latlong(field[0]),field[1])
+
+def format_nmea_latlong_dec(field):
+	return "%s%s" % (format_latlong_dec(field[0]),field[1])
+
+def format_nmea_raw(field):
+	return "%s%s" % field
+
+def format_nmea_alt(field):
+	return "%s %s" % field
+
+# key : (NMEA field it's made from, function to format it)
+LOCATION_VIEWS = {
+	'lat' : ('nmea_lat', format_nmea_latlong),
+	'long' : ('nmea_long', format_nmea_latlong),
+	'lat_dec' : ('nmea_lat', format_nmea_latlong_dec),
+	'long_dec' : ('nmea_long', format_nmea_latlong_dec),
+	'lat_raw' : ('nmea_lat', format_nmea_raw),
+	'long_raw' : ('nmea_long', format_nmea_raw),
+	'alt' : ('nmea_alt', format_nmea_alt),
+	'time' : ('nmea_time', format_time)
+}
+
+class LocationState:
+	"""The location, used like a dictionary. The handlers only store the
+	NMEA fields of the position ('nmea_lat', 'nmea_time', ...), the
+	display strings made from them (LOCATION_VIEWS) are formatted when
+	they are first read and kept until the next update. A display string
+	whose field is empty or can't be formatted is missing, like it was
+	when the handlers formatted them. Values which are set directly,
+	like those of the positioning module, are returned as they are."""
+	def __init__(self):
+		self.values = {}
+		self.views = {}		# display strings formatted since the last update
+
+	def view(self, key):
+		"""The display string key, formatted the first time it's asked for.
+		None if its NMEA field is empty, or is crud which can't be
+		formatted, as the handlers would have dropped it."""
+		if self.views.has_key(key):
+			return self.views[key]
+		field, format = LOCATION_VIEWS[key]
+		value = self.values.get(field)
+		if isinstance(value, tuple): present = value[0]
+		else: present = value
+		view = None
+		if present:
+			try:	view = format(value)
+			except NMEA_ERRORS: view = None
+		self.views[key] = view
+		return view
+
+	def has_key(self, key):
+		if self.values.has_key(key):
+			return True
+		if LOCATION_VIEWS.has_key(key):
+			return self.view(key) != None
+		return False
+
+	__contains__ = has_key
+
+	def __getitem__(self, key):
+		if self.values.has_key(key):
+			return self.values[key]
+		if LOCATION_VIEWS.has_key(key):
+			view = self.view(key)
+			if view != None: return view
+		raise KeyError(key)
+
+	def get(self, key, default = None):
+		if self.has_key(key): return self[key]
+		return default
+
+	def __setitem__(self, key, value):
+		self.values[key] = value
+		self.views.clear()
+
+	def __delitem__(self, key):
+		del self.values[key]
+		self.views.clear()
+
+	def update(self, values):
+		"""Stores a new update, the display strings of the NMEA fields in
+		it replace any that were set directly"""
+		for key, (field, format) in LOCATION_VIEWS.items():
+			if values.has_key(field) and self.values.has_key(key):
+				del self.values[key]
+		self.values.update(values)
+		self.views.clear()
+
+#############################################################################
+
+def count_bits(byte):
+	count = 0
+	while byte:
+		count += byte & 1
+		byte >>= 1
+	return count
+
+# Number of bits set, by byte
+BIT_COUNT = map(count_bits, range(256))
+
+# Satellite systems by NMEA talker, for the SatelliteTable and the GSA
+#  of multi-constellation receivers
+TALKER_SYSTEMS = {'GP' : 1, 'GL' : 2, 'GA' : 3, 'GB' : 4, 'BD' : 4, 'GQ' : 5, 'GI' : 6}
+
+# Added to the PRNs of the systems which number theirs from 1 too, so
+#  they don't clash with GPS in the table (GLONASS uses 65-96 already).
+#  QZSS lands on its NMEA 4.0 numbers, NavIC has none and gets 501-
+SYSTEM_PRN_OFFSETS = {3 : 300, 4 : 400, 5 : 192, 6 : 500}
+
+def prn_system(prn):
+	"""The satellite system of a PRN as NMEA 4.0 numbers them, for the GN
+	GSAs without a system ID: GPS and its SBAS 1-64, GLONASS 65-96,
+	QZSS 193-200, BeiDou 201-237 and 401-437, Galileo 301-336"""
+	if prn <= 64: return 1
+	if prn <= 96: return 2
+	if 193 <= prn <= 200: return 5
+	if 201 <= prn <= 299 or 401 <= prn <= 499: return 4
+	if 301 <= prn <= 399: return 3
+	return 0
+
+def system_prn(prn, system):
+	"""A PRN as a number which is unique over all satellite systems"""
+	if prn < 100: return prn + SYSTEM_PRN_OFFSETS.get(system, 0)
+	# BeiDou as NMEA 4.0 numbers it, the same satellites as 401-
+	if system == 4 and prn <= 299: return prn + 200
+	return prn
+
+class SatelliteTable:
+	"""The satellites in view: elevation, azimuth (degrees) and SNR (dB)
+	in arrays indexed by PRN, and a bitmap of the PRNs in view. The GSV
+	sentences of a cycle update it in place, and when the last one has
+	arrived the satellites which weren't in it are removed.
+	Every satellite system has its own cycles, they only remove their
+	own satellites."""
+	def __init__(self, size = 512):
+		self.size = size
+		self.elevation = array('f', [0.0]) * size
+		self.azimuth = array('f', [0.0]) * size
+		self.snr = array('f', [0.0]) * size
+		self.in_view = array('B', [0]) * ((size + 7) >> 3)
+		self.building = array('B', [0]) * ((size + 7) >> 3) # PRNs of the current cycle
+		self.empty = array('B', [0]) * ((size + 7) >> 3)
+		self.system = array('B', [0]) * size	# satellite system of each PRN
+		self.count = 0	# satellites in view
+
+	def start(self):
+		"""Starts a new cycle of GSV sentences"""
+		self.building[:] = self.empty
+
+	def set(self, prn, elevation, azimuth, snr, system = 0):
+		if prn < 0 or prn >= self.size: return
+		self.elevation[prn] = elevation
+		self.azimuth[prn] = azimuth
+		self.snr[prn] = snr
+		self.system[prn] = system
+		self.building[prn >> 3] |= 1 << (prn & 7)
+
+	def complete(self, system = 0):
+		"""Ends the cycle of a satellite system, the satellites in it are
+		the ones of the system in view now"""
+		count = 0
+		for i in range(len(self.in_view)):
+			gone = self.in_view[i] & ~self.building[i]
+			if gone:
+				for bit in range(8):
+					if gone & (1 << bit):
+						prn = (i << 3) + bit
+						if self.system[prn] == system:
+							self.elevation[prn] = self.azimuth[prn] = self.snr[prn] = 0.0
+						else:
+							gone &= ~(1 << bit)	# another system's
+			self.in_view[i] = (self.in_view[i] & ~gone) | self.building[i]
+			count += BIT_COUNT[self.in_view[i]]
+		self.count = count
+
+	def has(self, prn):
+		return 0 <= prn < self.size and self.in_view[prn >> 3] & (1 << (prn & 7)) != 0
+
+	def prns(self):
+		"""The PRNs in view, in ascending order"""
+		prns = []
+		for i in range(len(self.in_view)):
+			byte = self.in_view[i]
+			if byte:
+				for bit in range(8):
+					if byte & (1 << bit): prns.append((i << 3) + bit)
+		return prns
+
+#############################################################################
+
+def do_gga_location(d, state):
+	"""Get the location from a GGA sentence"""
+
+	# TODO: Detect if we're not getting speed containing sentences, but
+	#		we are geting location ones, so we need to compute the speed
+	#		for ourselves
+
+	location = {}
+	location['type'] = 'GGA'
+	location['nmea_lat'] = (d[1],d[2])
+	location['nmea_long'] = (d[3],d[4])
+	location['nmea_alt'] = (d[8],d[9])
+	location['nmea_time'] = d[0]
+	if d[5] == '0':
+		location['valid'] = 0
+	else:
+		location['valid'] = 1
+	fix = {
+		'lat' : nmea_degrees(d[1], d[2]),
+		'lon' : nmea_degrees(d[3], d[4]),
+		'alt' : nmea_float(d[8]),
+		'time' : nmea_seconds(d[0]),
+		'hdop' : nmea_float(d[7]),
+		'valid' : location['valid']
+	}
+	# The GPS time, if an RMC told us the date, else our clock's
+	fix['gps_time'] = gps_time(fix['time'], state)
+	if fix['gps_time'] != None:	location['tsecs'] = long(fix['gps_time'])
+	else:						location['tsecs'] = long(now())
+	return {'location' : location, 'fix' : fix}
+
+def do_gll_location(d, state):
+	"""Get the location from a GLL sentence"""
+
+	location = {}
+	location['type'] = 'GLL'
+	location['nmea_lat'] = (d[0],d[1])
+	location['nmea_long'] = (d[2],d[3])
+	location['nmea_time'] = d[4]
+	if d[5] == 'A':
+		location['valid'] = 1
+	elif d[5] == 'V':
+		location['valid'] = 0
+	fix = {
+		'lat' : nmea_degrees(d[0], d[1]),
+		'lon' : nmea_degrees(d[2], d[3]),
+		'time' : nmea_seconds(d[4])
+	}
+	if location.has_key('valid'): fix['valid'] = location['valid']
+	return {'location' : location, 'fix' : fix}
+
+def do_rmc_location(d, state):
+	"""Get the location from a RMC sentence"""
+
+	location = {}
+	location['type'] = 'RMC'
+	location['nmea_lat'] = (d[2],d[3])
+	location['nmea_long'] = (d[4],d[5])
+	location['nmea_time'] = d[0]
+	fix = {
+		'lat' : nmea_degrees(d[2], d[3]),
+		'lon' : nmea_degrees(d[4], d[5]),
+		'time' : nmea_seconds(d[0])
+	}
+	# speed over ground is in knots
+	if d[6]: fix['speed'] = float(d[6]) * 0.514444
+	if d[7]: fix['heading'] = float(d[7])
+
+	# The date only changes at midnight, so only work it out then
+	if d[8] != state.get('date'):
+		day = nmea_day(d[8])
+		state['date'] = d[8]
+		state['day_base'] = None
+		state['gps_time'] = None
+		if day != None: state['day_base'] = day * 86400
+	fix['gps_time'] = gps_time(fix['time'], state)
+	return {'location' : location, 'fix' : fix}
+
+#############################################################################
+
+def do_gsv_satellite_view(d, state):
+	"""Get the satellites we can see from a GSV sentence, into the
+	SatelliteTable of the parser state"""
+	table = state['satellites']
+	system = TALKER_SYSTEMS.get(state.get('talker'), 0)
+
+	# Are we starting a new set of sentences, or continuing one?
+	full_view_in = int(d[0])
+	sentence_no = int(d[1])
+	if sentence_no == 1:
+		table.start()
+
+	# Loop over the satellites in the sentence, grabbing their data
+	for i in range(3, len(d) - 3, 4):
+		if d[i]:
+			table.set(system_prn(int(d[i]), system), nmea_float(d[i+1]) or 0.0,
+				nmea_float(d[i+2]) or 0.0, nmea_float(d[i+3]) or 0.0, system)
+
+	# Have we got all the details from this set?
+	if sentence_no != full_view_in:
+		return {'more' : True}
+	table.complete(system)
+	return {'satellites' : {'in_view' : ["%02d" % prn for prn in table.prns()], 'table' : table}}
+
+def do_gsa_satellites_used(d, state):
+	"""Get the list of satellites we are using to get the fix.
+	Multi-constellation receivers send a GSA per satellite system, the
+	satellites of the systems are merged."""
+	satellites = {}
+
+	sats = d[2:13]
+	overall_dop = d[14]
+	horiz_dop = d[15]
+	vert_dop = d[16]
+
+	while (len(sats) > 0) and (not sats[-1]):
+		sats.pop()
+
+	# The system is in the talker, or as of NMEA 4.1 in the system ID of
+	#  GN. Before that, GN receivers only number the PRNs by system.
+	talker = state.get('talker', 'GP')
+	system = TALKER_SYSTEMS.get(talker, 0)
+	if len(d) > 17 and d[17]:
+		try:	system = int(d[17])
+		except ValueError: pass
+	elif system == 0 and sats:
+		system = prn_system(int(sats[0]))
+	if SYSTEM_PRN_OFFSETS.has_key(system):
+		sats = ["%02d" % system_prn(int(prn), system) for prn in sats]
+
+	# A system seen twice starts a new round, the systems which missed
+	#  the last round are gone
+	used = state.setdefault('used', {'round' : 0})
+	if used.has_key(system) and used[system][0] == used['round']:
+		used['round'] += 1
+	used[system] = (used['round'], sats)
+	in_use = []
+	for key, value in used.items():
+		if key != 'round' and value[0] >= used['round'] - 1:
+			in_use.extend(value[1])
+	in_use.sort(key = int)
+	satellites['in_use'] = in_use
+	satellites['overall_dop'] = overall_dop
+	satellites['horiz_dop'] = horiz_dop
+	satellites['vert_dop'] = vert_dop
+	fix = {
+		'pdop' : nmea_float(overall_dop),
+		'hdop' : nmea_float(horiz_dop),
+		'vdop' : nmea_float(vert_dop)
+	}
+	return {'satellites' : satellites, 'fix' : fix}
+
+def do_vtg_motion(d, state):
+	"""Get the current motion, from the VTG sentence"""
+	motion = {}
+
+	if not len(d[6]):
+		d[6] = 0.0
+	motion['speed_kmph'] = float(d[6])
+	motion['speed_mph'] = float(d[6]) / 1.609344
+	motion['true_heading'] = d[0]
+
+	motion['mag_heading'] = ''
+	if d[2] and float(d[2]) > 0:
+		motion['mag_heading'] = d[2]
+	fix = {
+		'speed' : motion['speed_kmph'] / 3.6,
+		'heading' : nmea_float(d[0])
+	}
+	return {'motion' : motion, 'fix' : fix}
+
+# Line end characters and '*', as characters and as bytes
+LINE_END = ('\r', ' ', '\t', 13, 32, 9)
+STAR = ('*', 42)
+
+#############################################################################
+
+class NmeaParser:
+	"""Frames NMEA sentences, checks their checksums and dispatches them
+	by sentence ID to the handlers. A handler is called with the list of
+	fields after the sentence ID and the parser state, and returns the
+	update.
+	log is called with a message when a sentence can't be parsed.
+	Sentences whose ID isn't in subscribed are dropped right after their
+	first six bytes, and counted in skipped.
+	What came in and what went wrong is counted in stats, sentences,
+	exceptions and parse_time, see clear_stats and report."""
+	def __init__(self, log = None):
+		self.buffer = ''	# incomplete sentence from the last feed
+		self.state = {'satellites' : SatelliteTable()} # kept by the handlers between sentences
+		self.log = log
+		self.stats = {}		# counters of the checked sentences, see clear_stats
+		self.clear_stats()
+		self.handlers = {
+			# The NMEA location sentences we're interested in are:
+			#  GGA - Global Positioning System Fix Data
+			#  GLL - Geographic Position
+			#  RMC - GPS Transit Data
+			'GGA' : do_gga_location,
+			'GLL' : do_gll_location,
+			'RMC' : do_rmc_location,
+			# The NMEA satellite sentences we're interested in are:
+			#  GSV - Satellites in view
+			#  GSA - Satellites used for positioning
+			'GSV' : do_gsv_satellite_view,
+			'GSA' : do_gsa_satellites_used,
+			# The NMEA motion sentences we're interested in are:
+			#  VTG - Track made good
+			# (RMC - GPS Transit - only in knots)
+			'VTG' : do_vtg_motion
+		}
+		self.subscribed = {}	# sentence IDs to parse, see subscribe
+		self.subscribe()
+		self.talkers = {'GP' : True}	# talkers to parse, None = any, see accept_talkers
+
+	def clear_stats(self):
+		self.stats = {
+			'bytes' : 0,			# fed to the parser
+			'lines' : 0,			# framed by the line ends
+			'checksum_ok' : 0,		# sentences with a correct checksum
+			'checksum_failed' : 0,	# sentences dropped for a wrong checksum
+			'fragments' : 0,		# lines without a '$', or with junk before it
+			'exceptions' : 0,		# sentences the handlers choked on
+		}
+		self.skipped = {}		# sentences not subscribed to, by address (talker and ID)
+		self.sentences = {}		# sentences parsed, by ID
+		self.exceptions = {}	# handler exceptions, by type
+		self.parse_time = {}	# seconds spent parsing, by sentence ID
+
+	def count_exception(self, inst):
+		"""Counts an exception of a handler, or of whatever used its update"""
+		name = inst.__class__.__name__
+		self.exceptions[name] = self.exceptions.get(name, 0) + 1
+		self.stats['exceptions'] += 1
+
+	def report(self):
+		"""The counters as lines of text, for the screen or a file"""
+		stats = self.stats
+		lines = ["%d bytes, %d lines, %d fragments" % (stats['bytes'], stats['lines'], stats['fragments']),
+			"checksums %d ok, %d failed" % (stats['checksum_ok'], stats['checksum_failed'])]
+		ids = self.sentences.keys()
+		ids.sort()
+		for sentence_id in ids:
+			count = self.sentences[sentence_id]
+			lines.append("%s %d, %.0f us each" % (sentence_id, count, self.parse_time.get(sentence_id, 0.) * 1e6 / count))
+		addresses = self.skipped.keys()
+		addresses.sort()
+		if addresses:
+			lines.append("skipped " + ', '.join(["%s %d" % (a, self.skipped[a]) for a in addresses]))
+		names = self.exceptions.keys()
+		names.sort()
+		if names:
+			lines.append("exceptions " + ', '.join(["%s %d" % (n, self.exceptions[n]) for n in names]))
+		return lines
+
+	def subscribe(self, sentence_ids = None):
+		"""Only parse the sentences with these IDs (like 'GGA'), all we have
+		handlers for if None"""
+		if sentence_ids == None:
+			sentence_ids = self.handlers.keys()
+		self.subscribed = {}
+		for sentence_id in sentence_ids:
+			if self.handlers.has_key(sentence_id):
+				self.subscribed[sentence_id] = True
+
+	def accept_talkers(self, talkers = ['GP']):
+		"""Only parse the sentences of these talkers, of any if None, like
+		the GN, GL and GA of multi-constellation receivers"""
+		if talkers == None:
+			self.talkers = None
+			return
+		self.talkers = {}
+		for talker in talkers: self.talkers[talker] = True
+
+	def feed(self, chunk):
+		"""Adds data from the GPS, returns the updates of all sentences
+		completed by it"""
+		self.stats['bytes'] += len(chunk)
+		lines = (self.buffer + chunk).split('\n')
+		self.buffer = lines.pop()
+		self.stats['lines'] += len(lines)
+
+		# When the sentences arrived, by the real clock, for the fix latency
+		arrived = time.time()
+		updates = []
+		for rawdata in lines:
+			update = self.parse(rawdata)
+			if update != None:
+				update['arrived'] = arrived
+				updates.append(update)
+		return updates
+
+	def parse(self, rawdata):
+		"""Parses a single sentence, returns its update or None if the
+		sentence is broken or not of interest"""
+
+		# Try to process the data from the GPS
+		# If it's gibberish, skip that line and move on
+		# (Not all bluetooth GPSs are created equal....)
+		# Discard fragmentary sentences -  start with the last '$'
+		startsign = rawdata.rfind('$')
+		if startsign != 0:
+			self.stats['fragments'] += 1
+			if startsign == -1:
+				return None
+
+		# Drop what we don't want before any more work is done on it
+		address = rawdata[startsign + 1:startsign + 6]
+		if (self.talkers != None and not self.talkers.has_key(address[0:2])) or not self.subscribed.has_key(address[2:5]):
+			if not address.isalnum(): address = '?'
+			self.skipped[address] = self.skipped.get(address, 0) + 1
+			return None
+
+		started = timer()
+		try:
+			data = rawdata[startsign:].rstrip()
+
+			# If it has a checksum, ensure that's correct
+			# (Checksum follows *, and is XOR of everything from
+			#  the $ to the *, exclusive)
+			if data[-3] == '*':
+				if not checksum_ok(data[1:-3], data[-2:]):
+					self.stats['checksum_failed'] += 1
+					return None
+				self.stats['checksum_ok'] += 1
+
+				# Strip the checksum
+				data = data[:-3]
+
+			# Grab the parts of the sentence
+			talker = data[1:3]
+			sentence_id = data[3:6]
+			sentence_data = data[7:]
+
+			handler = self.handlers.get(sentence_id)
+			if handler == None:
+				return None
+
+			self.state['talker'] = talker
+			update = handler(sentence_data.split(','), self.state)
+
+		# Catch exceptions cased by the GPS sending us crud
+		except NMEA_ERRORS, inst:
+			self.count_exception(inst)
+			if self.log: self.log("EXCEPTION: %s" % str(inst))
+			return None
+
+		self.sentences[sentence_id] = self.sentences.get(sentence_id, 0) + 1
+		self.parse_time[sentence_id] = self.parse_time.get(sentence_id, 0.) + timer() - started
+		update['sentence'] = sentence_id
+		update['talker'] = talker
+		update['raw'] = rawdata
+		return update
+
+	def parse_buffer(self, buf, start, end, view = None, raw = True):
+		"""Parses the sentence in buf[start:end], where buf is a bytearray
+		and view an optional memoryview of it. Works like parse, but finds
+		the '$', the '*' and the sentence ID by index: of a sentence which
+		is dropped only its address (talker and ID) is copied, of one a
+		handler reads only the fields, once. The raw sentence is only
+		copied into the update if raw is True."""
+		# Discard fragmentary sentences -  start with the last '$'
+		dollar = buf.rfind('$', start, end)
+		if dollar != start:
+			self.stats['fragments'] += 1
+			if dollar == -1:
+				return None
+
+		# Drop what we don't want before any more work is done on it
+		address = str(buf[dollar + 1:min(dollar + 6, end)])
+		if (self.talkers != None and not self.talkers.has_key(address[0:2])) or not self.subscribed.has_key(address[2:5]):
+			if not address.isalnum(): address = '?'
+			self.skipped[address] = self.skipped.get(address, 0) + 1
+			return None
+
+		started = timer()
+		try:
+			# strip the line end and trailing white space
+			line_end = end
+			while end > dollar and buf[end - 1] in LINE_END:
+				end -= 1
+
+			# If it has a checksum, ensure that's correct
+			stop = end
+			if buf[end - 3] == 42: # '*'
+				stop = end - 3
+				if view != None:	data = view[dollar + 1:stop]
+				else:				data = buf[dollar + 1:stop]
+				if not checksum_ok(data, (buf[stop + 1], buf[stop + 2])):
+					self.stats['checksum_failed'] += 1
+					return None
+				self.stats['checksum_ok'] += 1
+
+			talker = address[0:2]
+			sentence_id = address[2:5]
+			handler = self.handlers.get(sentence_id)
+			if handler == None:
+				return None
+
+			# The only copy of the sentence, split into its fields
+			if view != None:	fields = view[dollar + 7:stop].tobytes()
+			else:				fields = str(buf[dollar + 7:stop])
+			self.state['talker'] = talker
+			update = handler(fields.split(','), self.state)
+
+		# Catch exceptions cased by the GPS sending us crud
+		except NMEA_ERRORS, inst:
+			self.count_exception(inst)
+			if self.log: self.log("EXCEPTION: %s" % str(inst))
+			return None
+
+		self.sentences[sentence_id] = self.sentences.get(sentence_id, 0) + 1
+		self.parse_time[sentence_id] = self.parse_time.get(sentence_id, 0.) + timer() - started
+		update['sentence'] = sentence_id
+		update['talker'] = talker
+		if raw:	update['raw'] = str(buf[start:line_end])
+		else:	update['raw'] = None
+		return update
+
+	def parse_file(self, f, chunk_size = 1048576, raw = False):
+		"""Yields the updates of all sentences in the file f. Reads with
+		readinto into one reused bytearray, so only the sentences read
+		by a handler are copied."""
+		buf = bytearray(chunk_size)
+		view = memoryview(buf)
+		keep = 0 # bytes of an incomplete sentence at the start of buf
+		while True:
+			n = f.readinto(view[keep:])
+			if not n: break
+			self.stats['bytes'] += n
+			arrived = time.time()
+			end = keep + n
+			start = 0
+			pos = buf.find('\n', 0, end)
+			while pos != -1:
+				self.stats['lines'] += 1
+				update = self.parse_buffer(buf, start, pos, view, raw)
+				if update != None:
+					update['arrived'] = arrived
+					yield update
+				start = pos + 1
+				pos = buf.find('\n', start, end)
+
+			keep = end - start
+			if keep == chunk_size:	keep = 0 # longer than the buffer, can't be NMEA
+			elif keep > 0:			buf[0:keep] = buf[start:end]
+
+		if keep > 0:
+			self.stats['lines'] += 1
+			update = self.parse_buffer(buf, 0, keep, view, raw)
+			if update != None:
+				update['arrived'] = time.time()
+				yield update
+
+	def validate(self, buf, start = 0, end = None):
+		"""Checks the checksums of all lines in buf[start:end] (a string or
+		bytearray) at once. Returns the number of lines and a bitmap with
+		bit i set if line i is a sentence with a correct checksum, that
+		is bitmap[i >> 3] & (1 << (i & 7))."""
+		if end == None: end = len(buf)
+		bitmap = array('B')
+		byte = bit = lines = 0
+		while start < end:
+			pos = buf.find('\n', start, end)
+			if pos == -1: pos = end
+
+			# the sentence from the last '$' to the '*', ignoring the line end
+			stop = pos
+			while stop > start and buf[stop - 1] in LINE_END:
+				stop -= 1
+			dollar = buf.rfind('$', start, stop)
+			if dollar != -1 and stop - dollar > 3 and buf[stop - 3] in STAR:
+				if checksum_ok(buf[dollar + 1:stop - 3], buf[stop - 2:stop]):
+					byte |= 1 << bit
+					self.stats['checksum_ok'] += 1
+				else:
+					self.stats['checksum_failed'] += 1
+			else:
+				self.stats['checksum_failed'] += 1
+
+			lines += 1
+			bit += 1
+			if bit == 8:
+				bitmap.append(byte)
+				byte = bit = 0
+			start = pos + 1
+		if bit:
+			bitmap.append(byte)
+		return lines, bitmap
+
+#############################################################################
+
+class EpochAssembler:
+	"""Groups the updates of the sentences a GPS sends for one fix into
+	an epoch, so the fix is used once instead of once per sentence.
+
+	An epoch ends when a sentence with another UTC time arrives, or with
+	end_sentence if one is given. Without one, the sentence which ended
+	the last two epochs is taken as the end of the next ones, so they
+	don't have to wait for the first sentence of the next epoch. Only a
+	sentence which came once in its epoch is learned, like the last
+	part of a GSV cycle, but not the GSAs of a multi-constellation GPS.
+	Of a multi-part sentence, only the last part ends an epoch. A
+	learned end is dropped again when a timed sentence of its epoch
+	comes after it.
+	Untimed sentences (GSA, GSV, ...) are kept for the next fix rather
+	than being an epoch of their own, unless the GPS has never sent a
+	time. If no epoch ends for timeout seconds, the pending updates are
+	an epoch."""
+	def __init__(self, end_sentence = None, timeout = 2.0):
+		self.end_sentence = end_sentence
+		self.timeout = timeout
+		self.pending = []	# updates of the current epoch
+		self.timed = False	# whether a pending update had a time
+		self.started = 0	# arrival of the first pending update
+		self.time = None	# UTC time of the current epoch
+		self.ended = False	# whether the epoch of time was ended by the end sentence
+		self.last_end = None	# address (talker and ID) of the sentence which ended the last epoch
+		self.learned_end = None	# address of the sentence which ended the last two epochs
+
+	def learn(self, epoch):
+		"""Learns the end sentence from an epoch which was ended by the
+		time of the next one"""
+		last = epoch[-1]
+		address = last.get('talker', '') + last['sentence']
+		for update in epoch[:-1]:
+			if not update.has_key('more') and update.get('talker', '') + update['sentence'] == address:
+				address = None # it can repeat within an epoch
+				break
+		if address != None and address == self.last_end:	self.learned_end = address
+		else:												self.learned_end = None
+		self.last_end = address
+
+	def add(self, update, at = None):
+		"""Adds an update, returns the list of epochs (lists of updates) it
+		completed"""
+		if at == None: at = now()
+		epochs = []
+
+		t = None
+		if update.has_key('fix'): t = update['fix'].get('time')
+		if t != None:
+			if t != self.time:
+				if self.timed:
+					# The last sentence ended the epoch before this one
+					self.learn(self.pending)
+					epochs.append(self.pending)
+					self.pending = []
+					self.timed = False
+				self.ended = False
+			elif self.ended:
+				# The end sentence came before the end of its epoch. Don't
+				#  learn it again, and let this one go with the next fix
+				#  instead of being a fix of its own.
+				self.learned_end = self.last_end = None
+				t = None
+		if t != None:
+			self.time = t
+			self.timed = True
+
+		if not self.pending: self.started = at
+		self.pending.append(update)
+
+		if update.has_key('more'):
+			return epochs
+		if self.end_sentence != None:	ends = update['sentence'] == self.end_sentence
+		else:							ends = update.get('talker', '') + update['sentence'] == self.learned_end
+		if ends and (self.timed or self.time == None):
+			epochs.append(self.pending)
+			self.pending = []
+			self.ended = self.timed
+			self.timed = False
+		return epochs
+
+	def expire(self, at = None):
+		"""Returns the pending updates as an epoch if they waited too long"""
+		if at == None: at = now()
+		if not self.pending or at - self.started < self.timeout:
+			return []
+		epoch = self.pending
+		self.pending = []
+		self.timed = False
+		return [epoch]
@@ -0,0 +1,258 @@
+# Non-blocking NMEA streams for nmea_info.py on Linux
+#
+# Serial ports (USB adapters), ptys and TCP connections which deliver
+#  NMEA. Nothing blocks, not even connecting, so one thread can service
+#  several streams with select:
+#
+#  poller = StreamPoller()
+#  poller.add(SerialStream('/dev/ttyUSB0', 4800), handle)
+#  poller.add(open_stream('tcp:trackside:10110'), handle)
+#  while 1: poller.poll(1.)	# calls handle(stream, data) for what was read
+#
+# A stream which fails or is closed at the other end is reconnected
+#  after retry seconds.
+#
+# GPL
+
+import os, time, errno, socket, select
+
+# termios is only needed to set up serial ports
+has_termios = None
+OPEN_ERRORS = (OSError,)
+try:
+	import termios
+	has_termios = True
+	OPEN_ERRORS = (OSError, termios.error)
+except ImportError:
+	has_termios = False
+
+# Errors which only mean there's nothing to read right now
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+class NmeaStream:
+	"""A source of NMEA data. connect() starts to connect and returns if
+	the stream is ready, it's called again until it is. read() returns
+	the data there is, '' if there is none, and raises IOError when the
+	source is gone."""
+	retry = 5.	# seconds between connection attempts of a StreamPoller
+
+	def __init__(self):
+		self.connected = False
+		self.stats = {'connects' : 0, 'failures' : 0, 'bytes' : 0}
+
+	def fileno(self):
+		"""For select"""
+		return -1
+
+	def connect(self):
+		return False
+
+	def read(self, size = 4096):
+		return ''
+
+	def close(self):
+		self.connected = False
+
+	def failed(self, inst):
+		"""Closes the stream after an error, returns the error"""
+		self.stats['failures'] += 1
+		self.close()
+		return inst
+
+	def wait(self, timeout):
+		"""Waits up to timeout seconds for data, returns what was read"""
+		try:
+			ready = select.select([self], [], [], timeout)[0]
+		except select.error, inst:
+			if inst.args[0] != errno.EINTR: raise
+			ready = []
+		if not ready: return ''
+		return self.read()
+
+class SerialStream(NmeaStream):
+	"""A serial port like /dev/ttyUSB0 at baud, or a pty if baud is None"""
+	def __init__(self, device, baud = 4800):
+		NmeaStream.__init__(self)
+		self.device = device
+		self.baud = baud
+		self.fd = None
+
+	def __repr__(self):
+		return self.device
+
+	def fileno(self):
+		return self.fd
+
+	def connect(self):
+		if self.connected: return True
+		try:
+			self.fd = os.open(self.device, os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK)
+			if has_termios and os.isatty(self.fd): self.setup()
+		except OPEN_ERRORS, inst:
+			self.failed(inst)
+			return False
+		self.connected = True
+		self.stats['connects'] += 1
+		return True
+
+	def setup(self):
+		"""Raw 8N1 at our baud rate, the line ends are kept"""
+		attributes = termios.tcgetattr(self.fd)
+		attributes[0] = termios.IGNBRK | termios.IGNPAR	# iflag
+		attributes[1] = 0								# oflag
+		attributes[2] = termios.CS8 | termios.CREAD | termios.CLOCAL # cflag
+		attributes[3] = 0								# lflag
+		if self.baud != None:
+			speed = getattr(termios, 'B%d' % self.baud)
+			attributes[4] = attributes[5] = speed
+		termios.tcsetattr(self.fd, termios.TCSANOW, attributes)
+
+	def read(self, size = 4096):
+		try:
+			data = os.read(self.fd, size)
+		except OSError, inst:
+			if inst.errno in WOULD_BLOCK: return ''
+			raise IOError(self.failed(inst))
+		if not data:
+			# A hang up, the adapter was pulled or the pty closed
+			raise IOError(self.failed(IOError("%s closed" % self.device)))
+		self.stats['bytes'] += len(data)
+		return data
+
+	def close(self):
+		if self.fd != None:
+			try:	os.close(self.fd)
+			except OSError: pass
+			self.fd = None
+		self.connected = False
+
+class PtyStream(SerialStream):
+	"""The slave side of a pty, like the ones socat or a simulator make"""
+	def __init__(self, device):
+		SerialStream.__init__(self, device, None)
+
+class TcpStream(NmeaStream):
+	"""A TCP connection to host and port, like the NMEA servers of
+	trackside boxes and GPS daemons"""
+	def __init__(self, host, port):
+		NmeaStream.__init__(self)
+		self.address = (host, port)
+		self.sock = None
+		self.connecting = False
+
+	def __repr__(self):
+		return "%s:%d" % self.address
+
+	def fileno(self):
+		if self.sock == None: return -1
+		return self.sock.fileno()
+
+	def connect(self):
+		if self.connected: return True
+		try:
+			if not self.connecting:
+				self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+				self.sock.setblocking(0)
+				error = self.sock.connect_ex(self.address)
+				self.connecting = True
+			elif select.select([], [self.sock], [], 0)[1]:
+				error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+			else:
+				return False
+		except socket.error, inst:
+			self.failed(inst)
+			return False
+
+		if error in (errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK):
+			return False
+		if error != 0:
+			self.failed(socket.error(error, os.strerror(error)))
+			return False
+		self.connecting = False
+		self.connected = True
+		self.stats['connects'] += 1
+		return True
+
+	def read(self, size = 4096):
+		try:
+			data = self.sock.recv(size)
+		except socket.error, inst:
+			if inst.args[0] in WOULD_BLOCK: return ''
+			raise IOError(self.failed(inst))
+		if not data:
+			raise IOError(self.failed(IOError("%s closed the connection" % str(self))))
+		self.stats['bytes'] += len(data)
+		return data
+
+	def close(self):
+		if self.sock != None:
+			self.sock.close()
+			self.sock = None
+		self.connecting = False
+		self.connected = False
+
+def open_stream(source):
+	"""A stream for a source like serial:/dev/ttyUSB0:4800, pty:/dev/pts/3
+	or tcp:localhost:10110. A bare device path is a serial port at 4800."""
+	parts = source.split(':')
+	kind = parts[0].lower()
+	if kind == 'tcp' and len(parts) == 3:
+		return TcpStream(parts[1], int(parts[2]))
+	if kind == 'pty' and len(parts) == 2:
+		return PtyStream(parts[1])
+	if kind == 'serial' and len(parts) in (2, 3):
+		baud = 4800
+		if len(parts) == 3: baud = int(parts[2])
+		return SerialStream(parts[1], baud)
+	if len(parts) == 1:
+		return SerialStream(source)
+	raise ValueError("Unknown NMEA source %s" % source)
+
+class StreamPoller:
+	"""Services several streams from one thread: (re)connects them, and
+	hands what they deliver to their handler(stream, data)"""
+	def __init__(self):
+		self.streams = []	# [stream, handler, time of the next connection attempt]
+
+	def add(self, stream, handler):
+		self.streams.append([stream, handler, 0.])
+
+	def remove(self, stream):
+		self.streams = [entry for entry in self.streams if entry[0] is not stream]
+		stream.close()
+
+	def poll(self, timeout = 1.):
+		"""Waits up to timeout seconds for data, returns the number of reads"""
+		now = time.time()
+		readers = []
+		connecting = []
+		for entry in self.streams:
+			stream = entry[0]
+			if not stream.connected and now >= entry[2]:
+				if not stream.connect():
+					if stream.fileno() >= 0:	connecting.append(stream)
+					else:						entry[2] = now + stream.retry
+			if stream.connected:
+				readers.append(entry)
+
+		# Don't sleep through a reconnect which is due
+		waiting = [entry[2] - now for entry in self.streams if not entry[0].connected and entry[2] > now]
+		if waiting: timeout = min([timeout] + waiting)
+		try:
+			ready = select.select([entry[0] for entry in readers], connecting, [], max(0., timeout))[0]
+		except select.error, inst:
+			if inst.args[0] != errno.EINTR: raise
+			return 0
+
+		reads = 0
+		for entry in readers:
+			if entry[0] not in ready: continue
+			try:
+				data = entry[0].read()
+			except IOError:
+				entry[2] = time.time() + entry[0].retry
+				continue
+			if data:
+				entry[1](entry[0], data)
+				reads += 1
+		return reads